@@ -0,0 +1,126 @@
+"""Compressed, date-partitioned archive of messages aged out of the database.
+
+Layout: <root>/<group key>/<YYYY-MM-DD>_<first id>_<last id>.jsonl.gz, one
+message (as sent to clients) per line, oldest first, partitioned by the UTC
+day it was sent. A segment is written whole (temp file, fsync, rename) and
+never changed; compaction merges one day's segments into a new one and then
+removes the originals. Readers dedupe by id, so a crash between writing a
+segment and deleting its rows from the database only leaves harmless copies.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import List
+
+SEGMENT = re.compile(r"^(\d{4}-\d{2}-\d{2})_(\d+)_(\d+)\.jsonl\.gz$")
+
+
+def group_key(group_id: str) -> str:
+    # Group names are user input; never let one become a path
+    return hashlib.sha1(group_id.encode()).hexdigest()[:20]
+
+
+class ArchiveStore:
+    """Segment files plus an in-memory index of them; safe to share between threads."""
+    def __init__(self, root: str, cache_segments: int = 32):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.cache_segments = cache_segments
+        self._index = {}                 # group dir -> (dir mtime, [(first id, last id, day, path)] by first id)
+        self._rows = OrderedDict()       # path -> decoded rows; LRU
+        self._lock = threading.Lock()
+
+    def _dir(self, group_id: str) -> str:
+        return os.path.join(self.root, group_key(group_id))
+
+    def segments(self, group_id: str):
+        d = self._dir(group_id)
+        try: mtime = os.stat(d).st_mtime_ns
+        except FileNotFoundError: return []
+        with self._lock:
+            cached = self._index.get(d)
+            if cached and cached[0] == mtime: return cached[1]
+        segs = sorted((int(m[2]), int(m[3]), m[1], os.path.join(d, m[0])) for m in map(SEGMENT.match, os.listdir(d)) if m)
+        with self._lock: self._index[d] = (mtime, segs)
+        return segs
+
+    def _load(self, path: str):
+        with self._lock:
+            rows = self._rows.get(path)
+            if rows is not None: self._rows.move_to_end(path); return rows
+        with gzip.open(path, "rt", encoding="utf-8") as f: rows = [json.loads(line) for line in f]
+        with self._lock:
+            self._rows[path] = rows
+            while len(self._rows) > self.cache_segments: self._rows.popitem(last=False)
+        return rows
+
+    def read(self, group_id: str, before_id: int = None, after_id: int = 0, limit: int = 50) -> List[dict]:
+        """Up to `limit` archived messages with after_id < id < before_id, newest first."""
+        before_id = before_id if before_id is not None else float("inf")
+        found = {}
+        segs = self.segments(group_id)
+        reach = [0]  # reach[i]: highest id in segs[:i], so the scan can stop once nothing older can make the page
+        for s in segs: reach.append(max(reach[-1], s[1]))
+        for i in range(len(segs) - 1, -1, -1):
+            first, last, _, path = segs[i]
+            if len(found) >= limit and reach[i + 1] < sorted(found)[-limit]: break
+            if first >= before_id or last <= after_id: continue
+            try: rows = self._load(path)
+            except FileNotFoundError:
+                # Compacted away since the index was read; the merged segment is newer than our listing
+                with self._lock: self._index.pop(self._dir(group_id), None)
+                return self.read(group_id, before_id, after_id, limit)
+            for r in rows:
+                if after_id < r["id"] < before_id: found[r["id"]] = r
+        return [found[i] for i in sorted(found, reverse=True)[:limit]]
+
+    def write(self, group_id: str, items):
+        """Archive (epoch seconds, message dict) pairs, one new segment per UTC day."""
+        d = self._dir(group_id)
+        os.makedirs(d, exist_ok=True)
+        name_file = os.path.join(d, "group.txt")
+        if not os.path.exists(name_file):
+            with open(name_file, "w", encoding="utf-8") as f: f.write(group_id)
+        days = {}
+        for ts, msg in items: days.setdefault(datetime.fromtimestamp(ts or 0, timezone.utc).strftime("%Y-%m-%d"), []).append(msg)
+        for day, msgs in days.items(): self._write_segment(d, day, msgs)
+
+    def _write_segment(self, d: str, day: str, msgs: List[dict]) -> str:
+        msgs = sorted(msgs, key=lambda m: m["id"])
+        path = os.path.join(d, f"{day}_{msgs[0]['id']}_{msgs[-1]['id']}.jsonl.gz")
+        fd, tmp = tempfile.mkstemp(dir=d, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as f:
+                for m in msgs: f.write(json.dumps(m, ensure_ascii=False).encode() + b"\n")
+                f.close(); raw.flush(); os.fsync(raw.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+        return path
+
+    def compact(self) -> int:
+        """Merge each group-day's segments into one; returns how many segments were merged away."""
+        merged = 0
+        for key in os.listdir(self.root):
+            d = os.path.join(self.root, key)
+            if not os.path.isdir(d): continue
+            by_day = {}
+            for m in map(SEGMENT.match, os.listdir(d)):
+                if m: by_day.setdefault(m[1], []).append(os.path.join(d, m[0]))
+            for day, paths in by_day.items():
+                if len(paths) < 2: continue
+                rows = {}
+                for p in paths:
+                    with gzip.open(p, "rt", encoding="utf-8") as f:
+                        for line in f: r = json.loads(line); rows[r["id"]] = r
+                out = self._write_segment(d, day, list(rows.values()))
+                for p in paths:
+                    if p != out: os.remove(p); merged += 1
+        return merged
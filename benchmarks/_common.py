@@ -0,0 +1,39 @@
+"""Setup shared by the benchmarks: main.py imported from a scratch directory,
+and a websocket stand-in for driving ConnectionManager without a server.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_main():
+    """Import main.py from a fresh temp cwd, where it creates its db, uploads/ and archive/."""
+    os.chdir(tempfile.mkdtemp())
+    import main
+    return main
+
+
+class FakeWS:
+    """Accepts the handshake and counts frames; subclasses override `received` to inspect them."""
+    scope = {}
+
+    def __init__(self):
+        self.sent = 0
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code=1000):
+        pass
+
+    async def send_text(self, data):
+        self.sent += 1
+        self.received(data)
+
+    send_bytes = send_text
+
+    def received(self, data):
+        pass
@@ -0,0 +1,84 @@
+"""Send throughput with and without group commit, under several SQLite
+journal/synchronous settings.
+
+    python benchmarks/bench_batching.py [--producers 50] [--sends 100]
+
+Each configuration runs in a fresh subprocess because the pragmas are read
+from the environment when main.py is imported.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from _common import FakeWS, load_main
+
+CONFIGS = [("DELETE", "FULL"), ("WAL", "FULL"), ("WAL", "NORMAL")]
+
+
+class CountingWS(FakeWS):
+    def __init__(self, done):
+        super().__init__()
+        self.done = done
+
+    def received(self, data):
+        if self.sent == self.done[0]: self.done[1].set()
+
+
+async def scenario(main, batched, producers, sends):
+    manager = main.ConnectionManager()
+    done = [producers * sends, asyncio.Event()]
+    ws = CountingWS(done)
+    conn = main.Connection(ws, "reader", "general")
+    conn.queue = asyncio.Queue()  # unbounded: the reader must not be evicted mid-run
+    conn.writer = manager._spawn(manager._writer(conn))
+    manager.active_connections[ws] = conn
+    manager._join(conn, "general")
+    batcher = main.MessageBatcher(manager)
+
+    async def producer(p):
+        for i in range(sends):
+            fields = dict(sender=f"p{p}", content=f"msg {i}", msg_type="text", time="12:00", group_id="general")
+            if batched:
+                await batcher.submit(fields)
+                await asyncio.sleep(0)
+            else:
+                row, = await main.run_db(main.db_send_many, [fields], write=True)
+                await manager.broadcast_to_group({"action": "new", "message": row}, "general")
+
+    t = time.perf_counter()
+    await asyncio.gather(*(producer(p) for p in range(producers)))
+    await done[1].wait()
+    elapsed = time.perf_counter() - t
+    for task in list(manager._tasks) + [batcher.task]:
+        if task: task.cancel()
+    return producers * sends / elapsed
+
+
+def child(producers, sends):
+    main = load_main()
+    out = {mode: asyncio.run(scenario(main, mode == "batched", producers, sends)) for mode in ("single", "batched")}
+    print(json.dumps(out))
+
+
+def parent(producers, sends):
+    print(f"{producers} producers x {sends} sends")
+    print(f"{'journal':<8} {'sync':<7} {'single msgs/s':>14} {'batched msgs/s':>15} {'speedup':>8}")
+    for journal, sync in CONFIGS:
+        env = dict(os.environ, SQLITE_JOURNAL_MODE=journal, SQLITE_SYNCHRONOUS=sync)
+        res = subprocess.run([sys.executable, __file__, "--child", "--producers", str(producers), "--sends", str(sends)],
+                             env=env, capture_output=True, text=True, check=True)
+        r = json.loads(res.stdout.strip().splitlines()[-1])
+        print(f"{journal:<8} {sync:<7} {r['single']:14.0f} {r['batched']:15.0f} {r['batched'] / r['single']:7.1f}x")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--producers", type=int, default=50)
+    p.add_argument("--sends", type=int, default=100)
+    p.add_argument("--child", action="store_true")
+    a = p.parse_args()
+    (child if a.child else parent)(a.producers, a.sends)
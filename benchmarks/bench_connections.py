@@ -0,0 +1,85 @@
+"""Microbenchmark for ConnectionManager: join/switch/lookup and group fan-out
+over 10k fake sockets.
+
+    python benchmarks/bench_connections.py [--sockets 10000] [--groups 10]
+"""
+import argparse
+import asyncio
+import time
+
+from _common import FakeWS, load_main
+
+main = load_main()
+
+
+class StalledWS(FakeWS):
+    async def send_text(self, data):
+        await asyncio.sleep(3600)
+
+
+def timed(label, n, fn):
+    t = time.perf_counter()
+    fn()
+    dt = time.perf_counter() - t
+    print(f"{label:<28} {dt * 1e3:9.2f} ms  ({dt / n * 1e9:8.0f} ns/op)")
+
+
+async def run(sockets, groups):
+    manager = main.ConnectionManager()
+    socks = [FakeWS() for _ in range(sockets)]
+    names = [f"g{i}" for i in range(groups)]
+
+    # connect() broadcasts join notices, which is O(group) by design;
+    # measure the registry itself through the private join path.
+    def join_all():
+        for i, ws in enumerate(socks):
+            conn = main.Connection(ws, f"user{i}", names[i % groups])
+            conn.writer = manager._spawn(manager._writer(conn))
+            manager.active_connections[ws] = conn
+            manager._join(conn, conn.group)
+    timed("join", sockets, join_all)
+    timed("group_of", sockets, lambda: [manager.group_of(ws) for ws in socks])
+
+    def switch_all():
+        for i, ws in enumerate(socks):
+            conn = manager.active_connections[ws]
+            manager._leave(conn)
+            manager._join(conn, names[(i + 1) % groups])
+    timed("switch", sockets, switch_all)
+
+    rounds = 20
+    t = time.perf_counter()
+    for r in range(rounds):
+        await manager.broadcast_to_group_raw("x", names[r % groups])
+    dt = time.perf_counter() - t
+    per = sockets // groups
+    print(f"{'fan-out enqueue (1 group)':<28} {dt / rounds * 1e3:9.2f} ms  ({per} members/broadcast)")
+    t = time.perf_counter()
+    while manager.stats.sent < rounds * per: await asyncio.sleep(0)
+    print(f"{'fan-out drain':<28} {(time.perf_counter() - t) * 1e3:9.2f} ms")
+
+    # One stalled peer must not delay the rest; it is evicted once its queue fills.
+    stalled = StalledWS()
+    conn = main.Connection(stalled, "stalled", names[0])
+    conn.writer = manager._spawn(manager._writer(conn))
+    manager.active_connections[stalled] = conn
+    manager._join(conn, names[0])
+    t = time.perf_counter()
+    for _ in range(main.SEND_QUEUE_SIZE + 2):
+        await manager.broadcast_to_group_raw("x", names[0])
+        await asyncio.sleep(0)  # let the healthy writers drain, as between real frames
+    dt = time.perf_counter() - t
+    print(f"{'fan-out w/ stalled peer':<28} {dt / (main.SEND_QUEUE_SIZE + 2) * 1e3:9.2f} ms  "
+          f"(dropped: {manager.stats.dropped})")
+
+    t = time.perf_counter()
+    await manager.broadcast_to_group_raw("x", "missing")
+    print(f"{'fan-out (empty group)':<28} {(time.perf_counter() - t) * 1e6:9.2f} us")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--sockets", type=int, default=10000)
+    p.add_argument("--groups", type=int, default=10)
+    a = p.parse_args()
+    asyncio.run(run(a.sockets, a.groups))
@@ -0,0 +1,93 @@
+"""Load test: p99 broadcast latency while concurrent writers hit SQLite,
+with the commits done inline on the event loop (old behaviour) vs. in the
+db thread pool.
+
+    python benchmarks/bench_db_offload.py [--writers 20] [--sends 50] [--commit-delay-ms 5]
+
+--commit-delay-ms emulates slow storage by sleeping in every COMMIT.
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import event
+
+from _common import FakeWS, load_main
+
+main = load_main()
+
+
+class ProbeWS(FakeWS):
+    def __init__(self, latencies):
+        super().__init__()
+        self.latencies = latencies
+
+    def received(self, data):
+        if data.startswith("probe:"):
+            self.latencies.append(time.perf_counter() - float(data[6:]))
+
+
+def add(manager, ws, group):
+    conn = main.Connection(ws, "u", group)
+    conn.writer = manager._spawn(manager._writer(conn))
+    manager.active_connections[ws] = conn
+    manager._join(conn, group)
+
+
+def pct(xs, q):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] * 1e3 if xs else 0.0
+
+
+async def scenario(offload, writers, sends, members):
+    manager = main.ConnectionManager()
+    probe_lat, send_lat = [], []
+    for _ in range(members): add(manager, FakeWS(), "general")
+    add(manager, ProbeWS(probe_lat), "probe")
+
+    async def writer(w):
+        for i in range(sends):
+            t = time.perf_counter()
+            fields = dict(sender=f"w{w}", content=f"msg {i}", msg_type="text", time="12:00", group_id="general")
+            if offload: msg, = await main.run_db(main.db_send_many, [fields], write=True)
+            else: msg, = main.with_session(main.db_send_many, [fields])
+            await manager.broadcast_to_group({"action": "new", "message": msg}, "general")
+            send_lat.append(time.perf_counter() - t)
+            await asyncio.sleep(0)
+
+    async def probe(stop):
+        # Presence-style broadcasts that need no DB: their latency is pure loop stall
+        while not stop.is_set():
+            await manager.broadcast_to_group_raw(f"probe:{time.perf_counter()}", "probe")
+            await asyncio.sleep(0.002)
+
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(stop))
+    t = time.perf_counter()
+    await asyncio.gather(*(writer(w) for w in range(writers)))
+    elapsed = time.perf_counter() - t
+    stop.set(); await prober
+    await asyncio.sleep(0.05)
+    for task in list(manager._tasks): task.cancel()
+    return elapsed, probe_lat, send_lat
+
+
+def main_(a):
+    if a.commit_delay_ms:
+        event.listen(main.engine, "commit", lambda conn: time.sleep(a.commit_delay_ms / 1000))
+    print(f"{a.writers} writers x {a.sends} sends, {a.members} members, commit delay {a.commit_delay_ms}ms")
+    print(f"{'mode':<9} {'msgs/s':>8} {'send p50':>10} {'send p99':>10} {'bcast p50':>10} {'bcast p99':>10} {'bcast max':>10}")
+    for offload in (False, True):
+        elapsed, probe_lat, send_lat = asyncio.run(scenario(offload, a.writers, a.sends, a.members))
+        print(f"{'offload' if offload else 'inline':<9} {a.writers * a.sends / elapsed:8.0f} "
+              f"{pct(send_lat, .5):8.2f}ms {pct(send_lat, .99):8.2f}ms "
+              f"{pct(probe_lat, .5):8.2f}ms {pct(probe_lat, .99):8.2f}ms {pct(probe_lat, 1):8.2f}ms")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--writers", type=int, default=20)
+    p.add_argument("--sends", type=int, default=50)
+    p.add_argument("--members", type=int, default=50)
+    p.add_argument("--commit-delay-ms", type=float, default=5)
+    main_(p.parse_args())
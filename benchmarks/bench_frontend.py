@@ -0,0 +1,81 @@
+"""Frontend delivery: bytes a browser transfers on a cold and on a repeat visit,
+the startup cost of building the assets, and the cost of serving the page.
+
+    python benchmarks/bench_frontend.py [--requests 2000]
+
+"inline" is the page as it used to be served: one uncompressed HTML response
+with the CSS and JS inside it (the remote wallpaper it fetched is not counted).
+"""
+import argparse
+import re
+import time
+
+from fastapi.responses import HTMLResponse
+from fastapi.testclient import TestClient
+
+from _common import load_main
+
+main = load_main()
+
+BROWSER = {"accept-encoding": "gzip, deflate, br"}
+
+
+def wire_bytes(r):
+    # Status line, headers and body as they would cross the network (before TLS)
+    return len(f"HTTP/1.1 {r.status_code} OK\r\n") + sum(len(k) + len(v) + 4 for k, v in r.headers.items()) + 2 + r.num_bytes_downloaded
+
+
+def visit(client, cache):
+    """Load the page and what it references, revalidating against `cache` (url -> etag) like a browser."""
+    total, todo = 0, ["/"]
+    while todo:
+        url = todo.pop()
+        if url in cache and url != "/": continue  # immutable: not even revalidated
+        headers = dict(BROWSER, **({"if-none-match": cache[url]} if url in cache else {}))
+        r = client.get(url, headers=headers)
+        total += wire_bytes(r)
+        if r.status_code == 200:
+            cache[url] = r.headers["etag"]
+            todo += re.findall(r"""(?:href="|src="|url\(')(/static/[^"']+)""", r.text)
+        elif url == "/":
+            todo += [u for u in cache if u != "/"]
+    return total
+
+
+def inline_page():
+    page, body = main.assets.by_name["index.html"].bodies["identity"].decode(), lambda n: main.assets.by_name[n].bodies["identity"].decode()
+    page = page.replace(f'<link rel="stylesheet" href="{main.assets.by_name["app.css"].url}">', f"<style>\n{body('app.css')}</style>")
+    return page.replace(f'<script src="{main.assets.by_name["app.js"].url}"></script>', f"<script>\n{body('app.js')}</script>")
+
+
+def per_request(client, path, n, headers):
+    t = time.perf_counter()
+    for _ in range(n): client.get(path, headers=headers)
+    return (time.perf_counter() - t) / n
+
+
+def run(n):
+    t = time.perf_counter(); main.StaticAssets(main.STATIC_DIR); build = time.perf_counter() - t
+    encodings = sorted({e for a in main.assets.by_name.values() for e in a.bodies})
+    print(f"asset build at startup   {build * 1e3:8.1f} ms ({len(main.assets.by_name)} files, encodings: {', '.join(encodings)})")
+
+    page = inline_page()
+    main.app.add_api_route("/inline", lambda: HTMLResponse(page))
+    client = TestClient(main.app)
+    inline = wire_bytes(client.get("/inline", headers=BROWSER))
+    cache = {}
+    cold, repeat = visit(client, cache), visit(client, cache)
+    print(f"{'':<10} {'cold visit':>12} {'repeat visit':>14}")
+    print(f"{'inline':<10} {inline:>10} B {inline:>12} B")
+    print(f"{'assets':<10} {cold:>10} B {repeat:>12} B")
+
+    print(f"GET /inline              {per_request(client, '/inline', n, BROWSER) * 1e6:8.0f} us")
+    print(f"GET / (200)              {per_request(client, '/', n, BROWSER) * 1e6:8.0f} us")
+    print(f"GET / (304)              {per_request(client, '/', n, dict(BROWSER, **{'if-none-match': cache['/']})) * 1e6:8.0f} us")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--requests", type=int, default=2000)
+    a = p.parse_args()
+    run(a.requests)
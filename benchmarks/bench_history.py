@@ -0,0 +1,65 @@
+"""Join-latency benchmark: history page load as one group grows to millions
+of rows (from the DB and from the hot-history cache), compared with the old
+full-table dump.
+
+    python benchmarks/bench_history.py [--max-rows 1000000]
+"""
+import argparse
+import json
+import time
+
+from _common import load_main
+
+main = load_main()
+
+
+def fill(upto, have):
+    rows = [("user%d" % (i % 50), "پیام شماره %d" % i, "text", "12:00", "general" if i % 4 else "tech", False, False)
+            for i in range(have, upto)]
+    with main.engine.begin() as conn:
+        conn.exec_driver_sql(
+            "INSERT INTO messages (sender, content, msg_type, time, group_id, is_edited, is_pinned) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def best_of(fn, n=5):
+    best = float("inf")
+    for _ in range(n):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def full_dump():
+    db = main.SessionLocal()
+    msgs = db.query(main.MessageModel).filter(main.MessageModel.group_id == "general").all()
+    out = json.dumps({"action": "history", "messages": [main.row_to_dict(m) for m in msgs]})
+    db.close()
+    return out
+
+
+def run(max_rows):
+    print(f"{'rows':>10} {'join page':>12} {'cached join':>12} {'load_older':>12} {'full dump':>12} {'dump bytes':>12}")
+    have, size = 0, 1000
+    while size <= max_rows:
+        fill(size, have)
+        have = size
+        page = best_of(lambda: main.with_session(main.build_history_frame, "general").json())
+        cache = main.HistoryCache()
+        cache.fill("general", cache.begin_fill("general"), *main.with_session(main.load_first_page, "general"))
+        cached = best_of(lambda: cache.frame("general").json())
+        older = best_of(lambda: main.with_session(main.build_history_frame, "general", size // 2, "older").json())
+        if size <= 100_000:
+            dump = best_of(full_dump, 1)
+            dump_s, dump_b = f"{dump * 1e3:10.2f}ms", f"{len(full_dump()):12d}"
+        else:
+            dump_s, dump_b = f"{'skipped':>12}", f"{'-':>12}"
+        print(f"{size:>10} {page * 1e3:10.2f}ms {cached * 1e3:10.3f}ms {older * 1e3:10.2f}ms {dump_s} {dump_b}")
+        size *= 10
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--max-rows", type=int, default=1_000_000)
+    run(p.parse_args().max_rows)
@@ -0,0 +1,63 @@
+"""Media delivery: bytes and time to render a history page of images from
+originals vs. thumbnails, repeat visits, and audio seeking with Range.
+
+    python benchmarks/bench_media.py [--images 30]
+"""
+import argparse
+import io
+import os
+import time
+
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from _common import load_main
+
+main = load_main()
+
+
+def photo(seed):
+    # Noise over a gradient: compresses about like a phone photo
+    base = Image.linear_gradient("L").resize((1600, 1200)).convert("RGB")
+    noise = Image.effect_noise((1600, 1200), 30 + seed % 20).convert("RGB")
+    buf = io.BytesIO()
+    Image.blend(base, noise, 0.5).save(buf, "JPEG", quality=88)
+    return buf.getvalue()
+
+
+def fetch_all(client, urls, headers=None):
+    t, total, requests = time.perf_counter(), 0, 0
+    for u in urls:
+        r = client.get(u, headers=headers or {})
+        total += len(r.content); requests += 1
+    return total, (time.perf_counter() - t) * 1e3, requests
+
+
+def run(images):
+    with TestClient(main.app) as client:
+        urls = [client.post("/upload-file/", files={"file": (f"p{i}.jpg", photo(i))}).json()["url"] for i in range(images)]
+        thumbs = [main.thumb_url(u) for u in urls]
+        fetch_all(client, thumbs)  # make sure every thumbnail is rendered before timing
+
+        print(f"{images} images in one history page")
+        print(f"{'scenario':<34} {'bytes':>12} {'ms':>9} {'requests':>9}")
+        b, ms, n = fetch_all(client, urls)
+        print(f"{'first render, originals (before)':<34} {b:>12} {ms:9.1f} {n:>9}")
+        b, ms, n = fetch_all(client, thumbs)
+        print(f"{'first render, thumbnails':<34} {b:>12} {ms:9.1f} {n:>9}")
+        etag = client.get(thumbs[0]).headers["etag"]
+        b, ms, n = fetch_all(client, thumbs[:1], {"If-None-Match": etag})
+        print(f"{'repeat visit, revalidate (before)':<34} {b * images:>12} {'':>9} {images:>9}")
+        print(f"{'repeat visit, immutable cache':<34} {0:>12} {'':>9} {0:>9}")
+
+        note = client.post("/upload-file/", files={"file": ("v.webm", os.urandom(2 * 1024 * 1024))}).json()["url"]
+        full = len(client.get(note).content)
+        part = client.get(note, headers={"Range": "bytes=1048576-1114111"})
+        print(f"{'audio seek, whole file (before)':<34} {full:>12}")
+        print(f"{'audio seek, Range 64 KiB':<34} {len(part.content):>12} {'':>9} {part.status_code:>9}")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--images", type=int, default=30)
+    run(p.parse_args().images)
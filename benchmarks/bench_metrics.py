@@ -0,0 +1,58 @@
+"""Instrumentation overhead: cost of one histogram observation, of a /metrics
+scrape with many sockets, and of the sampling profiler on a busy fan-out loop.
+
+    python benchmarks/bench_metrics.py [--sockets 10000]
+"""
+import argparse
+import asyncio
+import time
+
+from _common import FakeWS, load_main
+from metrics import Histogram
+
+main = load_main()
+
+
+def per_op(fn, n):
+    t = time.perf_counter()
+    for _ in range(n): fn()
+    return (time.perf_counter() - t) / n
+
+
+async def fanout_rate(manager, groups, rounds=20):
+    frame, t = main.Frame({"action": "new"}), time.perf_counter()
+    for _ in range(rounds):
+        for g in groups: manager.deliver(frame, g)
+        await asyncio.sleep(0)  # the writers drain their queues
+    return rounds * len(groups) / (time.perf_counter() - t)
+
+
+async def run(sockets):
+    h = Histogram("x", "x", ("action",))
+    base = per_op(lambda: None, 1_000_000)
+    print(f"histogram observe            {(per_op(lambda: h.observe(0.003, 'send'), 1_000_000) - base) * 1e9:8.0f} ns")
+
+    manager = main.manager
+    groups = [f"g{i}" for i in range(100)]
+    for i in range(sockets):
+        conn = main.Connection(FakeWS(), f"user{i}", groups[i % len(groups)])
+        conn.writer = manager._spawn(manager._writer(conn))
+        manager.active_connections[conn.ws] = conn
+        manager._join(conn, conn.group)
+    t = time.perf_counter(); body = main.registry.render()
+    print(f"/metrics render, {sockets} sockets {(time.perf_counter() - t) * 1e3:8.2f} ms ({len(body)} bytes)")
+
+    off = await fanout_rate(manager, groups)
+    main.profiler.start(100)
+    on = await fanout_rate(manager, groups)
+    main.profiler.stop()
+    print(f"fan-out, profiler off        {off:8.0f} broadcasts/s")
+    print(f"fan-out, profiler at 100 Hz  {on:8.0f} broadcasts/s ({(1 - on / off) * 100:+.1f}% slower)")
+    for task in list(manager._tasks): task.cancel()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--sockets", type=int, default=10000)
+    a = p.parse_args()
+    asyncio.run(run(a.sockets))
@@ -0,0 +1,67 @@
+"""Presence traffic during a reconnect storm: every client in a group drops and
+immediately comes back, one after another, as after a server restart.
+
+Compares what members receive with joined/left deltas against the full user
+list that used to be re-sent to the whole group on every connect/disconnect.
+
+    python benchmarks/bench_presence.py [--clients 1000] [--tabs 2]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from _common import FakeWS, load_main
+
+main = load_main()
+
+
+class PresenceWS(FakeWS):
+    def __init__(self, counts):
+        super().__init__()
+        self.counts = counts
+
+    def received(self, data):
+        if '"action": "user_list"' in data or '"action": "presence"' in data:
+            self.counts["frames"] += 1; self.counts["bytes"] += len(data)
+
+
+async def run(clients, tabs):
+    manager = main.ConnectionManager()
+    counts = {"frames": 0, "bytes": 0}
+    users = [f"user{i}" for i in range(clients // tabs)]
+    socks = {}
+    for i in range(clients):
+        ws = socks[i] = PresenceWS(counts)
+        await manager.connect(ws, users[i % len(users)])
+    await asyncio.sleep(main.PRESENCE_DEBOUNCE_MS / 1000 * 2)
+    counts.update(frames=0, bytes=0)
+
+    # Storm: each socket, in random order, drops and reconnects
+    t = time.perf_counter()
+    order = list(range(clients)); random.shuffle(order)
+    for i in order:
+        await manager.disconnect(socks[i])
+        socks[i] = PresenceWS(counts)
+        await manager.connect(socks[i], users[i % len(users)])
+        await asyncio.sleep(1 / clients)
+    await asyncio.sleep(main.PRESENCE_DEBOUNCE_MS / 1000 * 2)
+    elapsed = time.perf_counter() - t
+
+    # The old scheme: a full, deduplicated list to every member on each connect and disconnect
+    full_list = len(json.dumps({"action": "user_list", "users": users, "count": len(users)}))
+    old_frames = 2 * clients * clients
+    print(f"{clients} sockets, {len(users)} users, storm took {elapsed:.2f}s")
+    print(f"{'':>8} {'frames':>12} {'bytes':>14}")
+    print(f"{'full':>8} {old_frames:>12} {old_frames * full_list:>14}")
+    print(f"{'deltas':>8} {counts['frames']:>12} {counts['bytes']:>14}")
+    for task in list(manager._tasks): task.cancel()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--clients", type=int, default=1000)
+    p.add_argument("--tabs", type=int, default=2, help="sockets per user")
+    a = p.parse_args()
+    asyncio.run(run(a.clients, a.tabs))
@@ -0,0 +1,117 @@
+"""Multi-worker fan-out benchmark: N uvicorn workers sharing one pub/sub
+broker (the bundled RESP stand-in, or a real Redis via --redis-url), driven
+by WebSocket clients spread over the workers.
+
+    python benchmarks/bench_pubsub.py [--workers 1 2 4] [--clients 200] [--groups 4] [--sends 20]
+
+Needs uvicorn, redis and websockets. Throughput can only scale with worker
+count when the machine has that many cores to spare next to this client.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+from _common import ROOT
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on {port}")
+
+
+async def client(port, name, group, sends, expected, start, ready):
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws/{name}", max_size=None) as ws:
+        await ws.send(json.dumps({"action": "join_group", "group": group}))
+        while json.loads(await ws.recv())["action"] != "history": pass
+        ready.release()
+        await start.wait()
+        got = 0
+
+        async def reader():
+            nonlocal got
+            while got < expected:
+                d = json.loads(await ws.recv())
+                if d["action"] == "new" and d["message"]["msg_type"] == "text": got += 1
+        r = asyncio.create_task(reader())
+        for i in range(sends):
+            await ws.send(json.dumps({"action": "send", "content": f"{name} {i}", "msg_type": "text"}))
+        await asyncio.wait_for(r, 120)
+        return got
+
+
+async def drive(ports, clients, groups, sends):
+    per_group = [sum(1 for c in range(clients) if c % groups == g) for g in range(groups)]
+    start, ready = asyncio.Event(), asyncio.Semaphore(0)
+    tasks = [asyncio.create_task(client(ports[c % len(ports)], f"c{c}", f"g{c % groups}", sends,
+                                        per_group[c % groups] * sends, start, ready)) for c in range(clients)]
+    for _ in range(clients): await ready.acquire()
+    await asyncio.sleep(1)  # let join/presence chatter settle
+    t = time.perf_counter()
+    start.set()
+    delivered = sum(await asyncio.gather(*tasks))
+    return delivered, time.perf_counter() - t
+
+
+def run_workers(n, broker_url):
+    ports = [free_port() for _ in range(n)]
+    cwd = tempfile.mkdtemp()  # shared SQLite file for all workers
+    env = dict(os.environ, PUBSUB_URL=broker_url, PUBSUB_CHANNEL=f"bench-{time.time()}")
+    procs = [subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", ROOT, "--port", str(p),
+                               "--log-level", "warning"], cwd=cwd, env=env) for p in ports]
+    for p in ports: wait_port(p)
+    return ports, procs
+
+
+def main(a):
+    broker = None
+    url = a.redis_url
+    if not url:
+        port = free_port()
+        broker = subprocess.Popen([sys.executable, os.path.join(HERE, "resp_broker.py"), "--port", str(port)])
+        wait_port(port)
+        url = f"redis://127.0.0.1:{port}/0"
+    print(f"{a.clients} clients, {a.groups} groups, {a.sends} sends each, broker {url}")
+    print(f"{'workers':>7} {'delivered':>10} {'seconds':>8} {'deliveries/s':>13}")
+    try:
+        for n in a.workers:
+            ports, procs = run_workers(n, url)
+            try:
+                delivered, secs = asyncio.run(drive(ports, a.clients, a.groups, a.sends))
+                print(f"{n:>7} {delivered:>10} {secs:8.2f} {delivered / secs:13.0f}")
+            finally:
+                for p in procs: p.terminate()
+                for p in procs: p.wait()
+    finally:
+        if broker: broker.terminate()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--clients", type=int, default=200)
+    p.add_argument("--groups", type=int, default=4)
+    p.add_argument("--sends", type=int, default=20)
+    p.add_argument("--redis-url", default="")
+    main(p.parse_args())
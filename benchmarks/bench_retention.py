@@ -0,0 +1,66 @@
+"""Retention: database size and history latency before and after a maintenance
+run archives everything older than the retention window.
+
+    python benchmarks/bench_retention.py [--rows 200000] [--days 60] [--keep 7]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from _common import load_main
+
+main = load_main()
+
+
+def fill(rows, days):
+    now, span = int(time.time()), days * 86400
+    for start in range(0, rows, 20000):
+        batch = [{"sender": f"u{i % 50}", "content": f"message number {i} about the release plan", "msg_type": "text",
+                  "time": "12:00", "group_id": "general", "created_at": now - span + span * i // rows}
+                 for i in range(start, min(rows, start + 20000))]
+        main.with_session(main.db_send_many, batch)
+
+
+def db_bytes():
+    return sum(os.path.getsize(f) for f in os.listdir() if f.startswith("telegram_clone.db"))
+
+
+def best_of(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter(); fn(); best = min(best, time.perf_counter() - t)
+    return best
+
+
+def measure(label, oldest_id):
+    page = best_of(lambda: main.with_session(main.load_history, "general"))
+    deep = best_of(lambda: main.with_session(main.load_history, "general", oldest_id + 100))
+    since = int(time.time()) - 86400
+    day = best_of(lambda: main.with_session(lambda db: db.query(main.MessageModel).filter(
+        main.MessageModel.group_id == "general", main.MessageModel.created_at >= since).count()))
+    print(f"{label:<8} {db_bytes() / 2 ** 20:8.1f} MB {page * 1e3:10.2f}ms {deep * 1e3:10.2f}ms {day * 1e3:10.2f}ms")
+
+
+def run(rows, days, keep):
+    main.RETENTION_GROUPS["general"] = keep
+    fill(rows, days)
+    main.with_session(lambda db: db.execute(main.text("PRAGMA wal_checkpoint(TRUNCATE)")))
+    print(f"{rows} messages over {days} days, keeping {keep} days in the db")
+    print(f"{'':<8} {'db size':>11} {'join page':>12} {'oldest page':>12} {'last 24h':>12}")
+    measure("before", 1)
+    t = time.perf_counter()
+    result = asyncio.run(main.maintenance.run())
+    print(f"maintenance: {time.perf_counter() - t:.2f}s {result}")
+    archived = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(main.ARCHIVE_DIR) for f in files)
+    measure("after", 1)
+    print(f"archive on disk: {archived / 2 ** 20:.1f} MB")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--days", type=int, default=60)
+    p.add_argument("--keep", type=float, default=7)
+    a = p.parse_args()
+    run(a.rows, a.days, a.keep)
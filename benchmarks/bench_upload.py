@@ -0,0 +1,79 @@
+"""Concurrent large uploads: throughput and event-loop stall for the streaming
+content-addressed upload path vs. the old UploadFile + shutil.copyfileobj handler.
+
+    python benchmarks/bench_upload.py [--uploads 8] [--mb 20]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import time
+import uuid
+
+import httpx
+from fastapi import File, UploadFile
+
+from _common import load_main
+
+os.environ.setdefault("UPLOAD_MAX_BYTES", str(1 << 30))
+main = load_main()
+
+
+@main.app.post("/legacy-upload/")
+async def legacy_upload(file: UploadFile = File(...)):
+    ext = file.filename.split(".")[-1]
+    name = f"{uuid.uuid4()}.{ext}"
+    with open(f"uploads/{name}", "wb") as f: shutil.copyfileobj(file.file, f)
+    return {"url": f"/uploads/{name}"}
+
+
+def body(payload, chunk=64 * 1024):
+    async def gen():
+        yield b'--BENCH\r\nContent-Disposition: form-data; name="file"; filename="big.bin"\r\n\r\n'
+        for i in range(0, len(payload), chunk): yield payload[i:i + chunk]
+        yield b"\r\n--BENCH--\r\n"
+    return gen()
+
+
+async def run(path, payloads):
+    stalls, stop = [], asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            t = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls.append(time.perf_counter() - t - 0.001)
+
+    tick = asyncio.create_task(ticker())
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        t = time.perf_counter()
+        res = await asyncio.gather(*(client.post(path, content=body(p),
+                                                 headers={"content-type": "multipart/form-data; boundary=BENCH"})
+                                     for p in payloads))
+        elapsed = time.perf_counter() - t
+    stop.set(); await tick
+    assert all(r.status_code == 200 for r in res), [r.text for r in res]
+    stalls.sort()
+    return elapsed, stalls[int(0.99 * len(stalls))] * 1e3, stalls[-1] * 1e3, res
+
+
+def main_(a):
+    size = a.mb * 1024 * 1024
+    unique = [os.urandom(size) for _ in range(a.uploads)]
+    same = [unique[0]] * a.uploads
+    print(f"{a.uploads} concurrent uploads x {a.mb} MB")
+    print(f"{'handler':<22} {'MB/s':>7} {'stall p99':>10} {'stall max':>10} {'new files':>10}")
+    for label, path, payloads in (("legacy", "/legacy-upload/", unique), ("streaming", "/upload-file/", unique),
+                                  ("streaming, duplicates", "/upload-file/", same)):
+        before = len(os.listdir("uploads"))
+        elapsed, p99, worst, _ = asyncio.run(run(path, payloads))
+        stored = len(os.listdir("uploads")) - before
+        print(f"{label:<22} {a.uploads * a.mb / elapsed:7.0f} {p99:8.2f}ms {worst:8.2f}ms {stored:>10}")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--uploads", type=int, default=8)
+    p.add_argument("--mb", type=int, default=20)
+    main_(p.parse_args())
@@ -0,0 +1,81 @@
+"""Wire formats: bytes on the wire and encode CPU for history frames, JSON vs.
+msgpack (per-message maps and columnar), each with and without permessage-deflate.
+
+    python benchmarks/bench_wire.py [--pages 50,500,5000]
+"""
+import argparse
+import random
+import time
+import zlib
+
+from _common import load_main
+
+main = load_main()
+if main.msgpack is None: raise SystemExit("bench_wire.py needs the msgpack package: pip install msgpack")
+
+WORDS = "سلام خوبی امروز جلسه ساعت فردا پروژه کد باگ درست شد ممنون عالی ok deploy test merge review".split()
+USERS = ["ali", "reza", "sara", "mina", "hamid", "neda"]
+
+
+def history(n, seed=0):
+    """A chat-like page: mostly short text, some replies, forwards, images and voice notes."""
+    rnd = random.Random(seed)
+    msgs = []
+    for i in range(1, n + 1):
+        kind = rnd.choices(["text", "image", "audio"], [90, 7, 3])[0]
+        content = (" ".join(rnd.choices(WORDS, k=rnd.randint(1, 14))) if kind == "text"
+                   else f"/uploads/{rnd.getrandbits(256):064x}.{'jpg' if kind == 'image' else 'webm'}")
+        reply = rnd.random() < 0.15 and msgs
+        m = {"id": i, "sender": rnd.choice(USERS), "content": content, "msg_type": kind,
+             "time": f"{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}",
+             "reply_to_sender": msgs[-1]["sender"] if reply else None,
+             "reply_to_content": msgs[-1]["content"][:60] if reply else None,
+             "is_edited": rnd.random() < 0.05, "is_pinned": False,
+             "forward_from": rnd.choice(USERS) if rnd.random() < 0.03 else None}
+        if kind == "image": m["thumb"] = main.thumb_url(content)
+        msgs.append(m)
+    return msgs
+
+
+def deflate(payload):
+    # permessage-deflate: raw deflate, a fresh window per message (no context takeover)
+    c = zlib.compressobj(wbits=-15)
+    return c.compress(payload.encode() if isinstance(payload, str) else payload) + c.flush(zlib.Z_SYNC_FLUSH)
+
+
+def best_of(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter(); fn(); best = min(best, time.perf_counter() - t)
+    return best
+
+
+def run(pages):
+    formats = {
+        "json": lambda msgs: main.HistoryFrame("history", msgs, True).json(),
+        "msgpack maps": lambda msgs: main.Frame({"action": "history", "messages": msgs, "has_more": True}).msgpack(),
+        "msgpack columnar": lambda msgs: main.HistoryFrame("history", msgs, True).msgpack(),
+    }
+    print(f"{'messages':>8} {'format':>17} {'bytes':>10} {'deflated':>10} {'encode':>10} {'+deflate':>10}")
+    for n in pages:
+        msgs = history(n)
+        for name, encode in formats.items():
+            payload = encode(msgs)
+            enc = best_of(lambda: encode(msgs))
+            both = best_of(lambda: deflate(encode(msgs)))
+            print(f"{n:>8} {name:>17} {len(payload):>10} {len(deflate(payload)):>10} {enc * 1e3:8.3f}ms {both * 1e3:8.3f}ms")
+
+    # One broadcast to many sockets: the frame is encoded once per format, not once per recipient
+    frame_data = {"action": "new", "message": history(1)[0]}
+    for recipients in (100, 10_000):
+        per_socket = best_of(lambda: [main.Frame(frame_data).encode("json") for _ in range(recipients)])
+        shared = main.Frame(frame_data)
+        once = best_of(lambda: [shared.encode("json" if i % 2 else "msgpack") for i in range(recipients)])
+        print(f"broadcast to {recipients}: encode per socket {per_socket * 1e3:.2f}ms, shared frame (mixed formats) {once * 1e3:.2f}ms")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--pages", default="50,500,5000", help="comma-separated history sizes")
+    a = p.parse_args()
+    run([int(x) for x in a.pages.split(",")])
@@ -0,0 +1,355 @@
+"""Load test: thousands of simulated WebSocket clients with a configurable mix
+of send / join_group / edit / pin / upload, against a server started for the
+run or one that is already up.
+
+    python benchmarks/loadtest.py [--server spawn|inproc|http://host:port] [--clients 1000] [--groups 20]
+                                  [--duration 30] [--rate 0.2] [--procs 1] [--out results.json]
+                                  [--mix send=70,join_group=10,edit=10,pin=5,upload=5]
+    python benchmarks/loadtest.py --compare before.json after.json
+
+Clients connect first (at most 100 handshakes at a time); the measured
+--duration starts once all of them are in. Each client then does one action at
+a time, with exponentially distributed think time (--rate actions per second
+per client). Reported:
+  - throughput and round-trip time per action (until the client sees its own echo),
+  - delivery latency: a send to every member socket of the group that receives it,
+  - server resident memory and connections, polled from /metrics.
+--out writes everything as JSON; --compare diffs two such files.
+
+spawn runs uvicorn in a subprocess (single worker, fresh db in a temp dir);
+inproc runs it on a thread of this process, so memory includes the clients.
+One client process saturates a core quickly; use --procs to spread clients.
+Needs websockets and httpx (and uvicorn unless --server is a URL).
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import httpx
+import websockets
+
+from _common import ROOT, load_main
+from bench_pubsub import free_port, wait_port
+
+ACTIONS = ("send", "join_group", "edit", "pin", "upload")
+TIMEOUT = 30
+SHARED = None  # (clients in so far, load start time), shared by all client processes
+
+
+def init_shared(arrived, start):
+    global SHARED
+    SHARED = (arrived, start)
+
+
+def arrive(total):
+    """Count a client as connected (or failed); the last one sets the start time."""
+    arrived, start = SHARED
+    with arrived.get_lock():
+        arrived.value += 1
+        if arrived.value == total: start.value = time.time() + 1
+
+
+async def load_start():
+    while not SHARED[1].value: await asyncio.sleep(0.1)
+    return SHARED[1].value
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        action, _, weight = part.partition("=")
+        if action not in ACTIONS: raise SystemExit(f"unknown action {action!r} in --mix (choose from {', '.join(ACTIONS)})")
+        mix[action] = float(weight or 1)
+    return mix
+
+
+def pct(samples, q):
+    if not samples: return None
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+def summary_ms(samples):
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {"n": len(samples), "p50": ms(pct(samples, 0.5)), "p90": ms(pct(samples, 0.9)),
+            "p99": ms(pct(samples, 0.99)), "max": ms(max(samples, default=None))}
+
+
+class SimClient:
+    def __init__(self, idx, cfg, res, http):
+        self.name = f"lt{idx}"
+        self.groups = cfg["groups"]
+        self.group = self.groups[idx % len(self.groups)]
+        self.cfg, self.res, self.http = cfg, res, http
+        self.own = {}          # group -> ids of this client's recent messages there
+        self.waiter = None     # (predicate, future) for the echo the current action waits for
+        self.rnd = random.Random(idx)
+
+    async def run(self, gate):
+        ws_url = self.cfg["base"].replace("http", "ws", 1) + f"/ws/{self.name}"
+        async with gate:
+            try:
+                ws = await websockets.connect(ws_url, max_size=None, open_timeout=120,
+                                              compression=None if self.cfg["no_deflate"] else "deflate")
+            except Exception:
+                self.res["connect_errors"] += 1; arrive(self.cfg["clients"]); return
+        reader = asyncio.create_task(self._read(ws))
+        arrived = False
+        try:
+            async with gate:
+                await self._request(ws, "join_group", {"action": "join_group", "group": self.group},
+                                    lambda d: d["action"] == "history", record=False)
+            self.res["connected"] += 1
+            arrive(self.cfg["clients"]); arrived = True
+            start_at = await load_start()
+            await asyncio.sleep(max(0, start_at - time.time()))
+            stop_at = start_at + self.cfg["duration"]
+            actions, weights = zip(*self.cfg["mix"].items())
+            while True:
+                await asyncio.sleep(self.rnd.expovariate(self.cfg["rate"]))
+                if time.time() >= stop_at: break
+                await getattr(self, "do_" + self.rnd.choices(actions, weights)[0])(ws)
+        except websockets.ConnectionClosed:
+            self.res["disconnects"] += 1
+        finally:
+            if not arrived: arrive(self.cfg["clients"])
+            reader.cancel()
+            await ws.close()
+
+    async def _read(self, ws):
+        res = self.res
+        try:
+            async for raw in ws:
+                d = json.loads(raw)
+                now = time.time()
+                if SHARED[1].value and now >= SHARED[1].value: res["frames"] += 1
+                if d["action"] == "new" and d["message"]["content"].startswith("lt "):
+                    res["delivery"].append(now - float(d["message"]["content"].rsplit(" ", 1)[1]))
+                if self.waiter and self.waiter[0](d):
+                    fut = self.waiter[1]; self.waiter = None
+                    if not fut.done(): fut.set_result(d)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _request(self, ws, action, payload, predicate, record=True):
+        fut = asyncio.get_running_loop().create_future()
+        self.waiter = (predicate, fut)
+        t = time.perf_counter()
+        await ws.send(json.dumps(payload))
+        try: d = await asyncio.wait_for(fut, TIMEOUT)
+        except asyncio.TimeoutError:
+            self.waiter = None
+            self.res["errors"][action] = self.res["errors"].get(action, 0) + 1
+            return None
+        if record: self.res["rtt"].setdefault(action, []).append(time.perf_counter() - t)
+        return d
+
+    async def _send(self, ws, action, content, msg_type="text"):
+        d = await self._request(ws, action, {"action": "send", "content": content, "msg_type": msg_type},
+                                lambda d: d["action"] == "new" and d["message"]["sender"] == self.name and d["message"]["content"] == content)
+        if d: self.own.setdefault(self.group, deque(maxlen=20)).append(d["message"]["id"])
+
+    async def do_send(self, ws):
+        await self._send(ws, "send", f"lt {self.name} {time.time():.6f}")
+
+    async def do_join_group(self, ws):
+        group = self.rnd.choice(self.groups)
+        self.group = group
+        await self._request(ws, "join_group", {"action": "join_group", "group": group}, lambda d: d["action"] == "history")
+
+    async def do_edit(self, ws):
+        ids = self.own.get(self.group)
+        if not ids: return await self.do_send(ws)
+        mid = ids[-1]
+        await self._request(ws, "edit", {"action": "edit", "id": mid, "content": f"edited {time.time():.3f}"},
+                            lambda d: d["action"] == "edit" and d["id"] == mid)
+
+    async def do_pin(self, ws):
+        ids = self.own.get(self.group)
+        if not ids: return await self.do_send(ws)
+        mid = self.rnd.choice(ids)
+        await self._request(ws, "pin", {"action": "pin", "id": mid}, lambda d: d["action"] == "pin" and d["id"] == mid)
+
+    async def do_upload(self, ws):
+        t = time.perf_counter()
+        try:
+            r = await self.http.post(self.cfg["base"] + "/upload-file/", files={"file": ("lt.webm", os.urandom(self.cfg["upload_bytes"]))})
+            r.raise_for_status()
+        except Exception:
+            self.res["errors"]["upload"] = self.res["errors"].get("upload", 0) + 1; return
+        self.res["rtt"].setdefault("upload_http", []).append(time.perf_counter() - t)
+        await self._send(ws, "upload", r.json()["url"], "audio")
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard: resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def run_shard_async(indices, cfg):
+    res = {"frames": 0, "delivery": [], "rtt": {}, "errors": {}, "connected": 0, "connect_errors": 0, "disconnects": 0}
+    gate = asyncio.Semaphore(100)  # connection ramp: at most this many handshakes in flight
+    async with httpx.AsyncClient(timeout=TIMEOUT, limits=httpx.Limits(max_connections=50)) as http:
+        await asyncio.gather(*(SimClient(i, cfg, res, http).run(gate) for i in indices))
+    return res
+
+
+def run_shard(args):
+    raise_fd_limit()
+    return asyncio.run(run_shard_async(*args))
+
+
+def scrape(base):
+    """Selected unlabeled samples from the server's /metrics."""
+    try: body = httpx.get(base + "/metrics", timeout=5).text
+    except Exception: return {}
+    out = {}
+    for line in body.splitlines():
+        name, _, value = line.partition(" ")
+        if name in ("process_resident_memory_bytes", "ws_connections"): out[name] = float(value)
+    return out
+
+
+class Server:
+    def __init__(self, mode):
+        self.mode, self.proc, self.thread = mode, None, None
+        if mode.startswith("http"): self.base = mode.rstrip("/"); return
+        port = free_port()
+        self.base = f"http://127.0.0.1:{port}"
+        if mode == "spawn":
+            self.proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", ROOT, "--port", str(port),
+                                          "--log-level", "warning"], cwd=tempfile.mkdtemp())  # fresh db and uploads/
+        elif mode == "inproc":
+            import uvicorn
+            main = load_main()
+            self.server = uvicorn.Server(uvicorn.Config(main.app, port=port, log_level="warning"))
+            self.thread = threading.Thread(target=self.server.run, daemon=True); self.thread.start()
+        else:
+            raise SystemExit(f"--server must be spawn, inproc or a URL, not {mode!r}")
+        wait_port(port, 60)
+
+    def stop(self):
+        if self.proc: self.proc.terminate(); self.proc.wait()
+        if self.thread: self.server.should_exit = True; self.thread.join(10)
+
+
+def git_rev():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError: return None
+
+
+def run(a):
+    raise_fd_limit()
+    mix = parse_mix(a.mix)
+    server = Server(a.server)
+    cfg = {"base": server.base, "groups": [f"lt-g{i}" for i in range(a.groups)], "mix": mix, "rate": a.rate,
+           "upload_bytes": a.upload_kb * 1024, "no_deflate": a.no_deflate, "clients": a.clients, "duration": a.duration}
+    shards = [(list(range(p, a.clients, a.procs)), cfg) for p in range(a.procs)]
+    ctx = multiprocessing.get_context("spawn")
+    arrived, start = ctx.Value("i", 0), ctx.Value("d", 0.0)
+
+    memory, connections, stop = [], [], threading.Event()
+
+    def poll():
+        while not stop.wait(1):
+            m = scrape(server.base)
+            if "process_resident_memory_bytes" in m: memory.append(m["process_resident_memory_bytes"])
+            if "ws_connections" in m: connections.append(m["ws_connections"])
+    poller = threading.Thread(target=poll, daemon=True); poller.start()
+    baseline = scrape(server.base).get("process_resident_memory_bytes")
+    began = time.time()
+    try:
+        if a.procs == 1:
+            init_shared(arrived, start)
+            parts = [run_shard(shards[0])]
+        else:
+            with ctx.Pool(a.procs, initializer=init_shared, initargs=(arrived, start)) as pool: parts = pool.map(run_shard, shards)
+    finally:
+        stop.set(); poller.join()
+        server.stop()
+
+    delivery = [x for p in parts for x in p["delivery"]]
+    rtt, errors = {}, {}
+    for p in parts:
+        for k, v in p["rtt"].items(): rtt.setdefault(k, []).extend(v)
+        for k, v in p["errors"].items(): errors[k] = errors.get(k, 0) + v
+    total = lambda key: sum(p[key] for p in parts)
+    mb = lambda v: None if v is None else round(v / 2 ** 20, 1)
+    ops = sum(len(v) for k, v in rtt.items() if k != "upload_http")
+    result = {
+        "started": datetime.fromtimestamp(start.value, timezone.utc).isoformat(), "git": git_rev(),
+        "config": {"server": a.server, "clients": a.clients, "groups": a.groups, "duration": a.duration, "rate": a.rate,
+                   "mix": mix, "procs": a.procs, "upload_kb": a.upload_kb, "deflate": not a.no_deflate},
+        "connected": total("connected"), "connect_errors": total("connect_errors"), "disconnects": total("disconnects"),
+        "connect_s": round(start.value - 1 - began, 2),
+        "throughput": {"actions_per_s": round(ops / a.duration, 1), "frames_received_per_s": round(total("frames") / a.duration, 1),
+                       "deliveries_per_s": round(len(delivery) / a.duration, 1)},
+        "actions": {k: {"count": len(v), "per_s": round(len(v) / a.duration, 2), "rtt_ms": summary_ms(v)} for k, v in sorted(rtt.items())},
+        "errors": errors,
+        "delivery_ms": summary_ms(delivery),
+        "server": {"rss_mb_start": mb(baseline), "rss_mb_peak": mb(max(memory, default=None)), "rss_mb_end": mb(memory[-1] if memory else None),
+                   "connections_peak": max(connections, default=None)},
+    }
+    return result
+
+
+def report(r):
+    print(f"{r['connected']}/{r['config']['clients']} clients connected in {r['connect_s']}s, {r['disconnects']} dropped, errors {r['errors'] or 'none'}")
+    t = r["throughput"]
+    print(f"throughput: {t['actions_per_s']} actions/s, {t['deliveries_per_s']} deliveries/s, {t['frames_received_per_s']} frames/s")
+    print(f"{'action':>12} {'count':>8} {'per s':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for k, v in r["actions"].items():
+        print(f"{k:>12} {v['count']:>8} {v['per_s']:>8} {v['rtt_ms']['p50']:>9} {v['rtt_ms']['p99']:>9}")
+    d = r["delivery_ms"]
+    print(f"delivery latency ms: p50 {d['p50']}  p90 {d['p90']}  p99 {d['p99']}  max {d['max']}  (n={d['n']})")
+    s = r["server"]
+    print(f"server RSS MB: start {s['rss_mb_start']}  peak {s['rss_mb_peak']}  end {s['rss_mb_end']}; peak connections {s['connections_peak']}")
+
+
+def compare(before, after):
+    def flat(r):
+        out = {"connect s": r["connect_s"], "actions/s": r["throughput"]["actions_per_s"], "deliveries/s": r["throughput"]["deliveries_per_s"]}
+        for q in ("p50", "p90", "p99"): out[f"delivery {q} ms"] = r["delivery_ms"][q]
+        for k, v in r["actions"].items(): out[f"{k} p99 ms"] = v["rtt_ms"]["p99"]
+        out["server peak RSS MB"] = r["server"]["rss_mb_peak"]
+        return out
+    a, b = flat(before), flat(after)
+    print(f"{'':>22} {before.get('git') or 'before':>12} {after.get('git') or 'after':>12} {'change':>8}")
+    for k in list(a) + [k for k in b if k not in a]:
+        x, y = a.get(k), b.get(k)
+        change = f"{(y - x) / x * 100:+.1f}%" if x and y is not None else ""
+        print(f"{k:>22} {str(x):>12} {str(y):>12} {change:>8}")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--server", default="spawn", help="spawn, inproc, or the base URL of a running server")
+    p.add_argument("--clients", type=int, default=1000)
+    p.add_argument("--groups", type=int, default=20)
+    p.add_argument("--duration", type=float, default=30, help="seconds of measured load, after all clients connect")
+    p.add_argument("--rate", type=float, default=0.2, help="actions per second per client")
+    p.add_argument("--mix", default="send=70,join_group=10,edit=10,pin=5,upload=5")
+    p.add_argument("--upload-kb", type=int, default=64)
+    p.add_argument("--procs", type=int, default=1, help="client processes")
+    p.add_argument("--no-deflate", action="store_true", help="don't offer permessage-deflate")
+    p.add_argument("--out", help="write results as JSON")
+    p.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="diff two --out files and exit")
+    a = p.parse_args()
+    if a.compare:
+        with open(a.compare[0]) as f0, open(a.compare[1]) as f1: compare(json.load(f0), json.load(f1))
+        sys.exit()
+    result = run(a)
+    report(result)
+    if a.out:
+        with open(a.out, "w") as f: json.dump(result, f, indent=2)
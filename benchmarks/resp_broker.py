@@ -0,0 +1,71 @@
+"""Minimal stand-in for Redis pub/sub (SUBSCRIBE/UNSUBSCRIBE/PUBLISH/PING over
+RESP2), enough for RedisBroker in tests and benchmarks without a Redis server.
+
+    python benchmarks/resp_broker.py [--port 6390]
+"""
+import argparse
+import asyncio
+
+
+def encode(value):
+    if isinstance(value, int): return b":%d\r\n" % value
+    if isinstance(value, (list, tuple)): return b"*%d\r\n" % len(value) + b"".join(encode(v) for v in value)
+    if isinstance(value, str): value = value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class RespBroker:
+    def __init__(self):
+        self.channels = {}  # channel -> set of writers
+
+    async def read_command(self, reader):
+        line = await reader.readline()
+        if not line: return None
+        if not line.startswith(b"*"): return line.split()  # inline command
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    async def handle(self, reader, writer):
+        subs = set()
+        try:
+            while True:
+                cmd = await self.read_command(reader)
+                if cmd is None: break
+                name = cmd[0].upper()
+                if name == b"SUBSCRIBE":
+                    for ch in cmd[1:]:
+                        subs.add(ch); self.channels.setdefault(ch, set()).add(writer)
+                        writer.write(encode([b"subscribe", ch, len(subs)]))
+                elif name == b"UNSUBSCRIBE":
+                    for ch in cmd[1:] or list(subs):
+                        subs.discard(ch); self.channels.get(ch, set()).discard(writer)
+                        writer.write(encode([b"unsubscribe", ch, len(subs)]))
+                elif name == b"PUBLISH":
+                    targets = self.channels.get(cmd[1], ())
+                    frame = encode([b"message", cmd[1], cmd[2]])
+                    for w in targets: w.write(frame)
+                    writer.write(encode(len(targets)))
+                elif name == b"PING":
+                    writer.write(encode([b"pong", b""]) if subs else b"+PONG\r\n")
+                else:  # CLIENT SETINFO, SELECT, ...
+                    writer.write(b"+OK\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for ch in subs: self.channels.get(ch, set()).discard(writer)
+            writer.close()
+
+
+async def serve(port):
+    server = await asyncio.start_server(RespBroker().handle, "127.0.0.1", port)
+    async with server: await server.serve_forever()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--port", type=int, default=6390)
+    asyncio.run(serve(p.parse_args().port))
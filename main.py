@@ -1,30 +1,140 @@
 import json
-import shutil
+import re
+import gzip
+import mimetypes
 import os
-import uuid
+import socket
+import hashlib
+import tempfile
+import time
+import asyncio
+import logging
+import multiprocessing
+from collections import deque, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
+from fastapi.responses import FileResponse, RedirectResponse, Response
 from typing import List, Dict
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from sqlalchemy import create_engine, event, text, Column, Integer, String, Boolean, Index
 from sqlalchemy.orm import sessionmaker, declarative_base 
+from sqlalchemy.exc import DBAPIError
+from thumbnails import make_thumbnail
+from metrics import Registry, SamplingProfiler
+from archive import ArchiveStore
+try: import fcntl
+except ImportError: fcntl = None
+try: import redis.asyncio as aioredis
+except ImportError: aioredis = None
+try: import msgpack
+except ImportError: msgpack = None
+try: import brotli
+except ImportError: brotli = None
+try: from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError: from multipart.multipart import MultipartParser, parse_options_header
 
 # --- 1. تنظیمات و دیتابیس ---
 if not os.path.exists("uploads"): os.makedirs("uploads")
+# Uploads stream here first, then move to uploads/<sha256>.<ext> (same filesystem, so the move is atomic)
+UPLOAD_TMP_DIR = os.path.join("uploads", ".incoming")
+os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+THUMB_DIR = os.path.join("uploads", "thumbs")
+os.makedirs(THUMB_DIR, exist_ok=True)
+log = logging.getLogger("telegram_clone")
+
+# Outbound queue bound (frames) and per-frame send timeout (seconds) for each socket
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", "256"))
+SEND_TIMEOUT = float(os.environ.get("SEND_TIMEOUT", "10"))
+# Messages per history page (on join and per load_older request)
+HISTORY_PAGE = int(os.environ.get("HISTORY_PAGE", "50"))
+# Groups whose latest history page is kept in memory (LRU)
+HISTORY_CACHE_GROUPS = int(os.environ.get("HISTORY_CACHE_GROUPS", "128"))
+# Threads serving history reads; writes always go through a single thread
+DB_READ_THREADS = int(os.environ.get("DB_READ_THREADS", "4"))
+# Group commit: sends are collected for up to SEND_BATCH_WINDOW_MS or SEND_BATCH_MAX rows per transaction
+SEND_BATCH_WINDOW_MS = float(os.environ.get("SEND_BATCH_WINDOW_MS", "5"))
+SEND_BATCH_MAX = int(os.environ.get("SEND_BATCH_MAX", "256"))
+# Sends waiting for a commit, across all sockets; when full, senders wait for room
+SEND_BACKLOG_MAX = int(os.environ.get("SEND_BACKLOG_MAX", str(4 * SEND_BATCH_MAX)))
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL").upper()    # WAL, DELETE, TRUNCATE, ...
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL").upper()   # OFF, NORMAL, FULL, EXTRA
+SEARCH_PAGE = int(os.environ.get("SEARCH_PAGE", "20"))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+# Longest side of image thumbnails (px) and processes rendering them
+THUMB_SIZE = int(os.environ.get("THUMB_SIZE", "320"))
+THUMB_WORKERS = int(os.environ.get("THUMB_WORKERS", "2"))
+IMAGE_EXTS = {"jpg", "jpeg", "png", "gif", "webp", "bmp"}
+# Multi-worker fan-out: redis://host:port/db to share events between workers; empty = single process
+PUBSUB_URL = os.environ.get("PUBSUB_URL", "")
+PUBSUB_CHANNEL = os.environ.get("PUBSUB_CHANNEL", "telegram_clone")
+# Seconds between full presence snapshots; a worker silent for 3 periods is dropped
+PRESENCE_HEARTBEAT = float(os.environ.get("PRESENCE_HEARTBEAT", "10"))
+# Presence changes are coalesced for this long, then sent as one joined/left delta per group
+PRESENCE_DEBOUNCE_MS = float(os.environ.get("PRESENCE_DEBOUNCE_MS", "250"))
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+# Only the newest SEARCH_WINDOW matches are ranked, so common words don't score the whole corpus
+SEARCH_WINDOW = int(os.environ.get("SEARCH_WINDOW", "5000"))
+# Clients offering the "msgpack" subprotocol get binary frames; everyone else gets JSON text
+WIRE_FORMATS = ("msgpack", "json") if msgpack is not None else ("json",)
+# permessage-deflate on the websocket (negotiated per connection in the handshake), see __main__
+WS_DEFLATE = os.environ.get("WS_DEFLATE", "1") != "0"
+# Lets POST /debug/profiler start the sampling profiler at runtime; off unless set to 1
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+# /metrics reports per-group connection counts for at most this many (largest) groups
+METRICS_MAX_GROUPS = int(os.environ.get("METRICS_MAX_GROUPS", "50"))
+# Retention: messages older than this many days move to compressed archive segments (0 = never)
+RETENTION_DAYS = float(os.environ.get("RETENTION_DAYS", "0"))
+# Per-group overrides of RETENTION_DAYS, e.g. "general=30,tech=7,announcements=0"
+RETENTION_GROUPS = {g.strip(): float(d) for g, _, d in (p.partition("=") for p in os.environ.get("RETENTION_GROUPS", "").split(",")) if g.strip()}
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+# Seconds between maintenance runs (retention, archive compaction, vacuum); 0 disables them
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", "3600"))
+# Rows archived per write transaction, so sends never wait behind one huge delete
+ARCHIVE_BATCH = int(os.environ.get("ARCHIVE_BATCH", "2000"))
+# Allow maintenance to run one full VACUUM on a file not yet in incremental auto_vacuum mode. It rewrites
+# the whole database on the write thread, so sends stall until it ends; off unless set to 1
+MAINTENANCE_FULL_VACUUM = os.environ.get("MAINTENANCE_FULL_VACUUM", "0") == "1"
+# Frontend files, served from memory: versioned by content hash and compressed once at startup
+STATIC_DIR = os.environ.get("STATIC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./telegram_clone.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Hot-path metrics, served on /metrics; gauges and existing counters are registered next to /stats
+registry = Registry()
+profiler = SamplingProfiler()
+action_seconds = registry.histogram("ws_action_seconds", "Time to handle one client frame, by action.", ("action",))
+db_seconds = registry.histogram("db_seconds", "DB call latency including pool queueing, by function.", ("op",))
+fanout_seconds = registry.histogram("broadcast_fanout_seconds", "Time to enqueue one broadcast to this worker's members.")
+delivery_seconds = registry.histogram("frame_delivery_seconds", "Time from enqueue to send complete, per frame.")
+handled_errors = registry.counter("handled_errors_total", "Exceptions caught and survived, by where they happened.", ("where",))
+WS_ACTIONS = {"join_group", "load_older", "search", "send", "edit", "delete", "pin", "unpin"}
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _):
+    if SQLITE_JOURNAL_MODE not in ("WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "OFF"): raise ValueError(f"bad SQLITE_JOURNAL_MODE {SQLITE_JOURNAL_MODE}")
+    if SQLITE_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"): raise ValueError(f"bad SQLITE_SYNCHRONOUS {SQLITE_SYNCHRONOUS}")
+    cur = dbapi_conn.cursor()
+    # Takes effect on a new database (so before journal_mode writes the header), or at the next VACUUM;
+    # lets maintenance return free pages a few at a time
+    cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cur.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cur.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cur.close()
 Base = declarative_base()
 
 class MessageModel(Base):
     __tablename__ = "messages"
+    __table_args__ = (Index("ix_messages_group_id_id", "group_id", "id"), Index("ix_messages_group_id_pinned", "group_id", "is_pinned"),
+                      Index("ix_messages_group_id_created_at", "group_id", "created_at"))
     id = Column(Integer, primary_key=True, index=True)
     sender = Column(String)
     content = Column(String)
     msg_type = Column(String) # text, image, audio, system
-    time = Column(String)
+    time = Column(String)  # HH:MM as shown to clients
+    created_at = Column(Integer, default=lambda: int(time.time()))  # epoch seconds
     group_id = Column(String)
     reply_to_sender = Column(String, nullable=True)
     reply_to_content = Column(String, nullable=True)
@@ -32,50 +142,750 @@ class MessageModel(Base):
     is_edited = Column(Boolean, default=False)
     is_pinned = Column(Boolean, default=False)
 
-Base.metadata.create_all(bind=engine)
+# --- Full-text search (FTS5 over text messages) ---
+# unicode61 alone splits words at ZWNJ and treats Arabic/Persian letter variants as
+# different letters, so content is normalized in Python before indexing and querying.
+_FA_TRANSLATE = {ord(a): b for a, b in {
+    "\u064a": "\u06cc", "\u0649": "\u06cc", "\u0643": "\u06a9", "\u0629": "\u0647", "\u06c0": "\u0647",  # ي ى ك ة ۀ
+    "\u0623": "\u0627", "\u0625": "\u0627",  # أ إ -> ا
+    "\u200c": "", "\u200d": "", "\u0640": "",  # ZWNJ, ZWJ, tatweel
+}.items()}
+_FA_TRANSLATE.update({c: None for c in range(0x064B, 0x0660)})  # harakat
+_FA_TRANSLATE[0x0670] = None
+_FA_TRANSLATE.update({0x06F0 + i: str(i) for i in range(10)})  # Persian digits
+_FA_TRANSLATE.update({0x0660 + i: str(i) for i in range(10)})  # Arabic-Indic digits
+
+def normalize_fa(s: str) -> str:
+    return s.translate(_FA_TRANSLATE)
+
+def fts_query(q: str) -> str:
+    """User text -> FTS5 MATCH expression: every word must match, last one as a prefix."""
+    words = re.findall(r"\w+", normalize_fa(q))
+    if not words: return ""
+    return " ".join(f'"{w}"' for w in words[:-1]) + f' "{words[-1]}"*'
+
+def init_fts():
+    with engine.begin() as conn:
+        is_new = not conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").first()
+        conn.exec_driver_sql("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                             "content, group_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')")
+        if not is_new: return
+        # Backfill a database created before search existed
+        rows = conn.exec_driver_sql("SELECT id, content, group_id FROM messages WHERE msg_type = 'text'").fetchall()
+        if rows: conn.exec_driver_sql("INSERT INTO messages_fts (rowid, content, group_id) VALUES (?, ?, ?)",
+                                      [(i, normalize_fa(c or ""), g) for i, c, g in rows])
+
+def migrate_created_at():
+    # Databases from before created_at only know HH:MM; their rows count as created at upgrade time
+    with engine.begin() as conn:
+        if any(c[1] == "created_at" for c in conn.exec_driver_sql("PRAGMA table_info(messages)")): return
+        conn.exec_driver_sql("ALTER TABLE messages ADD COLUMN created_at INTEGER")
+        conn.exec_driver_sql("UPDATE messages SET created_at = ?", (int(time.time()),))
+
+def init_db():
+    # Several workers may start at once; the loser of a CREATE race retries and finds the schema in place
+    for attempt in range(10):
+        try:
+            Base.metadata.create_all(bind=engine)
+            migrate_created_at()
+            # create_all skips indexes of tables that already exist
+            for ix in MessageModel.__table__.indexes: ix.create(bind=engine, checkfirst=True)
+            init_fts()
+            return
+        except DBAPIError:
+            if attempt == 9: raise
+            time.sleep(0.1 * (attempt + 1))
+
+init_db()
+archive = ArchiveStore(ARCHIVE_DIR)
+
+def fts_insert(db, rows):
+    """Index (message dict, group_id) pairs; only text messages are searchable."""
+    params = [{"id": r["id"], "content": normalize_fa(str(r["content"])), "g": g} for r, g in rows if r["msg_type"] == "text"]
+    if params: db.execute(text("INSERT INTO messages_fts (rowid, content, group_id) VALUES (:id, :content, :g)"), params)
+
+def load_history(db, group_id: str, before_id: int = None, limit: int = HISTORY_PAGE):
+    """Newest `limit` messages of a group older than `before_id`, oldest first, and whether more remain."""
+    q = db.query(MessageModel).filter(MessageModel.group_id == group_id)
+    if before_id is not None: q = q.filter(MessageModel.id < before_id)
+    rows = q.order_by(MessageModel.id.desc()).limit(limit + 1).all()
+    msgs = [row_to_dict(m) for m in rows]
+    # Archived messages are older than what the db still holds (pins stay behind), so they
+    # only show up once the page reaches past the db's oldest rows; the db copy wins on overlap.
+    floor = rows[-1].id if len(rows) > limit else 0
+    archived = archive.read(group_id, before_id, floor, limit + 1)
+    if archived: msgs = sorted({m["id"]: m for m in archived + msgs}.values(), key=lambda m: m["id"], reverse=True)[:limit + 1]
+    return list(reversed(msgs[:limit])), len(msgs) > limit
+
+def load_pinned(db, group_id: str):
+    m = db.query(MessageModel).filter(MessageModel.group_id == group_id, MessageModel.is_pinned == True).first()
+    return {"id": m.id, "content": m.content} if m else None
+
+def render_history(action: str, msg_jsons, has_more: bool, pinned=None, with_pinned: bool = True) -> str:
+    """Assemble a history frame from already-serialized messages."""
+    tail = f', "pinned": {json.dumps(pinned)}' if with_pinned else ""
+    return f'{{"action": "{action}", "messages": [{", ".join(msg_jsons)}], "has_more": {json.dumps(has_more)}{tail}}}'
+
+# --- Wire formats: a frame is encoded lazily, at most once per format, and shared by every recipient ---
+class Frame:
+    __slots__ = ("_data", "_json", "_msgpack")
+
+    def __init__(self, data: dict = None, json_str: str = None):
+        self._data, self._json, self._msgpack = data, json_str, None
+
+    @property
+    def data(self) -> dict:
+        if self._data is None: self._data = json.loads(self._json)
+        return self._data
+
+    def json(self) -> str:
+        if self._json is None: self._json = json.dumps(self._data)
+        return self._json
+
+    def msgpack(self) -> bytes:
+        if self._msgpack is None: self._msgpack = msgpack.packb(self.data, use_bin_type=True)
+        return self._msgpack
+
+    def encode(self, fmt: str):
+        return self.msgpack() if fmt == "msgpack" else self.json()
+
+# Column order of message rows in binary history frames
+MESSAGE_COLUMNS = ("id", "sender", "content", "msg_type", "time", "reply_to_sender", "reply_to_content",
+                   "is_edited", "is_pinned", "forward_from", "thumb")
+
+class HistoryFrame(Frame):
+    """History page. JSON keeps the per-message objects; msgpack sends `columns` once and `rows` as lists."""
+    __slots__ = ("action", "msgs", "msg_jsons", "has_more", "pinned", "with_pinned")
+
+    def __init__(self, action: str, msgs: List[dict], has_more: bool, pinned=None, with_pinned: bool = True, msg_jsons=None):
+        super().__init__()
+        self.action, self.msgs, self.msg_jsons = action, msgs, msg_jsons
+        self.has_more, self.pinned, self.with_pinned = has_more, pinned, with_pinned
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            d = {"action": self.action, "columns": MESSAGE_COLUMNS,
+                 "rows": [[m.get(c) for c in MESSAGE_COLUMNS] for m in self.msgs], "has_more": self.has_more}
+            if self.with_pinned: d["pinned"] = self.pinned
+            self._data = d
+        return self._data
+
+    def json(self) -> str:
+        if self._json is None:
+            self._json = render_history(self.action, self.msg_jsons or map(json.dumps, self.msgs), self.has_more,
+                                        self.pinned, self.with_pinned)
+        return self._json
+
+def as_frame(frame) -> Frame:
+    return frame if isinstance(frame, Frame) else Frame(json_str=frame)
+
+def load_first_page(db, group_id: str):
+    msgs, has_more = load_history(db, group_id)
+    # The pinned message may be older than the first page
+    return msgs, has_more, load_pinned(db, group_id)
+
+def build_history_frame(db, group_id: str, before_id: int = None, action: str = "history") -> HistoryFrame:
+    if before_id is None:
+        msgs, has_more, pinned = load_first_page(db, group_id)
+        return HistoryFrame(action, msgs, has_more, pinned)
+    msgs, has_more = load_history(db, group_id, before_id)
+    return HistoryFrame(action, msgs, has_more, with_pinned=False)
+
+def db_send_many(db, batch: List[dict]) -> List[dict]:
+    """Insert a batch of messages in one transaction; returns them serialized, in order, with ids."""
+    msgs = [MessageModel(**fields) for fields in batch]
+    db.add_all(msgs); db.flush()
+    # Serialize before commit: commit expires the objects and would reload each row
+    rows = [row_to_dict(m) for m in msgs]
+    fts_insert(db, zip(rows, (f["group_id"] for f in batch)))
+    db.commit()
+    return rows
+
+def db_edit(db, msg_id: int, sender: str, content: str):
+    """Returns the edited message's group, or None if it isn't the sender's."""
+    msg = db.query(MessageModel).filter(MessageModel.id == msg_id, MessageModel.sender == sender).first()
+    if not msg: return None
+    msg.content = content = str(content); msg.is_edited = True
+    if msg.msg_type == "text":
+        db.execute(text("UPDATE messages_fts SET content = :c WHERE rowid = :id"), {"c": normalize_fa(content), "id": msg_id})
+    db.commit()
+    return msg.group_id
+
+def db_delete(db, msg_id: int, sender: str):
+    """Returns the deleted message's group, or None if it isn't the sender's."""
+    msg = db.query(MessageModel).filter(MessageModel.id == msg_id, MessageModel.sender == sender).first()
+    if not msg: return None
+    group_id = msg.group_id
+    db.delete(msg)
+    db.execute(text("DELETE FROM messages_fts WHERE rowid = :id"), {"id": msg_id})
+    db.commit()
+    return group_id
+
+def db_pin(db, group_id: str, msg_id: int):
+    db.query(MessageModel).filter(MessageModel.group_id == group_id).update({MessageModel.is_pinned: False})
+    msg = db.query(MessageModel).filter(MessageModel.id == msg_id, MessageModel.group_id == group_id).first()
+    if not msg: return None
+    msg.is_pinned = True; db.commit()
+    return {"id": msg.id, "content": msg.content}
+
+def db_search(db, group_id: str, query: str, offset: int = 0, limit: int = SEARCH_PAGE):
+    """Ranked (bm25) text-message hits in one group; returns the page and the next offset or None."""
+    match = fts_query(query)
+    if not match: return [], None
+    ids = [r[0] for r in db.execute(text(
+        "SELECT rowid FROM (SELECT rowid, rank FROM messages_fts WHERE messages_fts MATCH :q AND group_id = :g "
+        "ORDER BY rowid DESC LIMIT :w) ORDER BY rank LIMIT :n OFFSET :o"),
+        {"q": match, "g": group_id, "w": SEARCH_WINDOW, "n": limit + 1, "o": offset})]
+    next_offset = offset + limit if len(ids) > limit else None
+    ids = ids[:limit]
+    by_id = {m.id: m for m in db.query(MessageModel).filter(MessageModel.id.in_(ids))}
+    return [row_to_dict(by_id[i]) for i in ids if i in by_id], next_offset
+
+def build_search_frame(db, group_id: str, query: str, offset: int) -> Frame:
+    msgs, next_offset = db_search(db, group_id, query, offset)
+    return Frame({"action": "search_results", "query": query, "offset": offset, "messages": msgs, "next_offset": next_offset})
+
+def db_unpin(db, group_id: str):
+    db.query(MessageModel).filter(MessageModel.group_id == group_id).update({MessageModel.is_pinned: False}); db.commit()
+
+# --- Blocking SQLAlchemy calls run in threads, never on the event loop ---
+# SQLite has a single writer, so one write thread serializes commits instead of
+# contending for the lock; reads get their own pool so history never waits on a commit.
+db_write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+db_read_pool = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-read")
+
+def with_session(fn, *args):
+    db = SessionLocal()
+    try: return fn(db, *args)
+    finally: db.close()
+
+async def run_db(fn, *args, write: bool = False):
+    pool = db_write_pool if write else db_read_pool
+    started = time.perf_counter()
+    try: return await asyncio.get_running_loop().run_in_executor(pool, with_session, fn, *args)
+    finally: db_seconds.observe(time.perf_counter() - started, fn.__name__)
+
+# --- Retention, archival and vacuum, in the background ---
+def retention_days(group_id: str) -> float:
+    return RETENTION_GROUPS.get(group_id, RETENTION_DAYS)
+
+def db_groups(db) -> List[str]:
+    return [g for (g,) in db.query(MessageModel.group_id).distinct()]
+
+def db_archive_batch(db, group_id: str, cutoff: int, limit: int = ARCHIVE_BATCH) -> int:
+    """Move up to `limit` of the group's unpinned messages created before `cutoff` to the archive."""
+    rows = (db.query(MessageModel).filter(MessageModel.group_id == group_id, MessageModel.created_at < cutoff,
+                                          MessageModel.is_pinned == False)
+            .order_by(MessageModel.id).limit(limit).all())
+    if not rows: return 0
+    # Segment first: if the delete below never commits, readers just see the same ids twice and dedupe
+    archive.write(group_id, [(m.created_at, row_to_dict(m)) for m in rows])
+    ids = [m.id for m in rows]
+    db.query(MessageModel).filter(MessageModel.id.in_(ids)).delete(synchronize_session=False)
+    db.execute(text("DELETE FROM messages_fts WHERE rowid = :id"), [{"id": i} for i in ids])
+    db.commit()
+    return len(ids)
+
+def db_reclaim(db, pages: int = 2000) -> dict:
+    """Give free pages back to the filesystem: a bounded incremental step, or (if allowed) one full VACUUM for old files."""
+    db.close()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        mode, free, total = (conn.exec_driver_sql(f"PRAGMA {p}").scalar() for p in ("auto_vacuum", "freelist_count", "page_count"))
+        # executescript steps the pragma to completion; a plain execute frees a single page
+        if free and mode == 2: conn.connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({pages})")
+        # A file created before auto_vacuum was set needs one VACUUM (which also switches it to incremental)
+        elif MAINTENANCE_FULL_VACUUM and mode != 2 and free > total // 5: conn.exec_driver_sql("VACUUM")
+        reclaimed = free - conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        if reclaimed and SQLITE_JOURNAL_MODE == "WAL": conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        conn.exec_driver_sql("PRAGMA optimize")
+    return {"pages_reclaimed": reclaimed, "pages_free": free - reclaimed}
+
+def db_fts_optimize(db):
+    db.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")); db.commit()
+
+class Maintenance:
+    """Periodic retention, archive compaction and vacuum; one worker at a time holds the lock file."""
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self.task: asyncio.Task = None
+        self.runs = 0
+        self.archived = 0
+        self.last: dict = {}
+
+    def start(self):
+        if self.task is None and self.interval > 0: self.task = asyncio.create_task(self._loop())
 
-app = FastAPI()
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+    async def stop(self):
+        if self.task is None: return
+        self.task.cancel()
+        try: await self.task
+        except asyncio.CancelledError: pass
+        self.task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try: await self.run()
+            except Exception: handled_errors.inc("maintenance"); log.exception("maintenance run failed")
+
+    async def run(self) -> dict:
+        lock = open(os.path.join(ARCHIVE_DIR, ".maintenance.lock"), "w")
+        try:
+            if fcntl is not None:
+                try: fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError: return {"skipped": "another worker is running maintenance"}
+            return await self._run()
+        finally:
+            lock.close()
+
+    async def _run(self) -> dict:
+        started, archived = time.perf_counter(), 0
+        now = int(time.time())
+        for g in await run_db(db_groups):
+            days = retention_days(g)
+            if days <= 0: continue
+            # Batches go through the write thread one at a time, so sends interleave with them
+            while n := await run_db(db_archive_batch, g, now - int(days * 86400), write=True): archived += n
+        if archived: await run_db(db_fts_optimize, write=True)
+        compacted = await asyncio.to_thread(archive.compact)
+        reclaimed = 0
+        while True:  # bounded steps, like the archive batches
+            step = await run_db(db_reclaim, write=True)
+            reclaimed += step["pages_reclaimed"]
+            if not step["pages_reclaimed"] or not step["pages_free"]: break
+        self.runs += 1; self.archived += archived
+        self.last = {"at": now, "seconds": round(time.perf_counter() - started, 3), "archived": archived,
+                     "segments_compacted": compacted, "pages_reclaimed": reclaimed, "pages_free": step["pages_free"]}
+        log.info("maintenance: %s", self.last)
+        return self.last
+
+    def snapshot(self) -> dict:
+        return {"runs": self.runs, "archived": self.archived, "last": self.last}
+
+maintenance = Maintenance()
+
+# --- Hot history: latest page of recently used groups, kept pre-serialized ---
+class GroupHistory:
+    __slots__ = ("messages", "has_more", "pinned")
+
+    def __init__(self, msgs: List[dict], has_more: bool, pinned):
+        # id -> [message dict, its JSON]; oldest first, at most HISTORY_PAGE entries
+        self.messages = OrderedDict((m["id"], [m, json.dumps(m)]) for m in msgs)
+        self.has_more = has_more
+        self.pinned = pinned
+
+class HistoryCache:
+    """Per-group ring buffers of recent messages, updated write-through after each commit."""
+    def __init__(self, max_groups: int = HISTORY_CACHE_GROUPS, page: int = HISTORY_PAGE):
+        self.groups: "OrderedDict[str, GroupHistory]" = OrderedDict()
+        self.max_groups = max_groups
+        self.page = page
+        self.hits = 0
+        self.misses = 0
+        self._filling: Dict[str, object] = {}
+
+    def frame(self, group_id: str):
+        h = self.groups.get(group_id)
+        if h is None: self.misses += 1; return None
+        self.hits += 1
+        self.groups.move_to_end(group_id)
+        entries = h.messages.values()
+        return HistoryFrame("history", [e[0] for e in entries], h.has_more, h.pinned, msg_jsons=[e[1] for e in entries])
+
+    def begin_fill(self, group_id: str) -> object:
+        """Token for a DB load; any write to the group before fill() makes the load stale."""
+        token = self._filling[group_id] = object()
+        return token
+
+    def fill(self, group_id: str, token: object, msgs: List[dict], has_more: bool, pinned):
+        if self._filling.get(group_id) is not token: return
+        del self._filling[group_id]
+        if self.max_groups <= 0: return
+        self.groups[group_id] = GroupHistory(msgs, has_more, pinned)
+        while len(self.groups) > self.max_groups: self.groups.popitem(last=False)
+
+    def _written(self, group_id: str):
+        self._filling.pop(group_id, None)
+        return self.groups.get(group_id)
+
+    def on_new(self, group_id: str, msg: dict, msg_json: str):
+        h = self._written(group_id)
+        if h is None: return
+        h.messages[msg["id"]] = [msg, msg_json]
+        if len(h.messages) > self.page: h.messages.popitem(last=False); h.has_more = True
+
+    def on_edit(self, group_id: str, msg_id: int, content: str):
+        h = self._written(group_id)
+        if h is None: return
+        e = h.messages.get(msg_id)
+        if e: e[0] = {**e[0], "content": content, "is_edited": True}; e[1] = json.dumps(e[0])
+        if h.pinned and h.pinned["id"] == msg_id: h.pinned = {"id": msg_id, "content": content}
+
+    def on_delete(self, group_id: str, msg_id: int):
+        h = self._written(group_id)
+        if h is None: return
+        if h.pinned and h.pinned["id"] == msg_id: h.pinned = None
+        if msg_id in h.messages:
+            del h.messages[msg_id]
+            # The page is now short; refilling needs the DB, so drop it unless it is the whole group
+            if h.has_more: del self.groups[group_id]
+
+    def on_pin(self, group_id: str, pinned):
+        h = self._written(group_id)
+        if h is None: return
+        for mid, e in h.messages.items():
+            if e[0]["is_pinned"] != (pinned is not None and mid == pinned["id"]):
+                e[0] = {**e[0], "is_pinned": not e[0]["is_pinned"]}; e[1] = json.dumps(e[0])
+        h.pinned = pinned
+
+    def apply(self, group_id: str, op):
+        """Apply a write-through op shipped with a broadcast, e.g. ("edit", id, content)."""
+        getattr(self, "on_" + op[0])(group_id, *op[1:])
+
+    def snapshot(self) -> dict:
+        return {"groups": len(self.groups), "hits": self.hits, "misses": self.misses}
+
+history_cache = HistoryCache()
+
+async def history_frame(group_id: str, before_id: int = None, action: str = "history") -> HistoryFrame:
+    if before_id is not None: return await run_db(build_history_frame, group_id, before_id, action)
+    frame = history_cache.frame(group_id)
+    if frame is not None: return frame
+    token = history_cache.begin_fill(group_id)
+    msgs, has_more, pinned = await run_db(load_first_page, group_id)
+    history_cache.fill(group_id, token, msgs, has_more, pinned)
+    return HistoryFrame(action, msgs, has_more, pinned)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Background work lives as long as the worker, whether or not it ever serves a websocket
+    maintenance.start()
+    try: yield
+    finally: await maintenance.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # --- 2. مدیریت اتصال‌ها ---
+# Every broadcast and presence change goes through a broker; each worker's subscriber
+# then applies cache updates and delivers to its own sockets only.
+class Broker:
+    """Delivers every published event to every worker, the publisher included."""
+    shared = False
+
+    async def start(self, handler): raise NotImplementedError
+
+    async def publish(self, event: dict): raise NotImplementedError
+
+class LocalBroker(Broker):
+    """Single process: publishing is a direct call and nothing is serialized."""
+    async def start(self, handler): self.handler = handler
+
+    async def publish(self, event: dict): await self.handler(event)
+
+class RedisBroker(Broker):
+    """Redis (or anything speaking its PUBLISH/SUBSCRIBE) shared by all workers."""
+    shared = True
+
+    def __init__(self, url: str, channel: str = PUBSUB_CHANNEL):
+        if aioredis is None: raise RuntimeError("PUBSUB_URL requires the 'redis' package")
+        self.url, self.channel = url, channel
+        self.redis = self.pubsub = self.task = None
+
+    async def start(self, handler):
+        self.redis = aioredis.from_url(self.url)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(self.channel)
+        self.task = asyncio.create_task(self._listen(handler))
+
+    async def _listen(self, handler):
+        while True:
+            try:
+                async for m in self.pubsub.listen():
+                    try: await handler(json.loads(m["data"]))
+                    except Exception: handled_errors.inc("pubsub_event"); log.exception("bad pub/sub event")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                handled_errors.inc("pubsub_connection"); log.exception("pub/sub connection lost, resubscribing")
+                await asyncio.sleep(1)
+
+    async def publish(self, event: dict):
+        if isinstance(event.get("frame"), Frame): event = {**event, "frame": event["frame"].json()}
+        await self.redis.publish(self.channel, json.dumps(event))
+
+def make_broker(url: str = PUBSUB_URL) -> Broker:
+    return RedisBroker(url) if url else LocalBroker()
+
+class Connection:
+    __slots__ = ("ws", "username", "group", "queue", "writer", "fmt")
+
+    def __init__(self, ws: WebSocket, username: str, group: str, fmt: str = "json"):
+        self.ws = ws
+        self.username = username
+        self.group = group
+        self.fmt = fmt
+        self.queue: asyncio.Queue = asyncio.Queue(SEND_QUEUE_SIZE)
+        self.writer: asyncio.Task = None
+
+class FanoutStats:
+    """Counters for the broadcast path, served on /stats."""
+    def __init__(self, samples: int = 1024):
+        self.broadcasts = 0
+        self.frames = 0
+        self.sent = 0
+        self.dropped = {"overflow": 0, "timeout": 0, "error": 0}
+        self.fanout_times = deque(maxlen=samples)    # time to enqueue one broadcast
+        self.delivery_times = deque(maxlen=samples)  # enqueue -> send_text done
+
+    @staticmethod
+    def _pct(samples, q):
+        if not samples: return 0.0
+        s = sorted(samples)
+        return s[min(len(s) - 1, int(q * len(s)))]
+
+    def snapshot(self) -> dict:
+        ms = lambda samples, q: round(self._pct(samples, q) * 1000, 3)
+        return {
+            "broadcasts": self.broadcasts, "frames_enqueued": self.frames, "frames_sent": self.sent,
+            "dropped": dict(self.dropped),
+            "fanout_ms": {"p50": ms(self.fanout_times, 0.5), "p99": ms(self.fanout_times, 0.99)},
+            "delivery_ms": {"p50": ms(self.delivery_times, 0.5), "p99": ms(self.delivery_times, 0.99)},
+        }
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[Dict] = []
+    def __init__(self, broker: Broker = None, worker_id: str = WORKER_ID):
+        # websocket -> Connection, and group -> {websocket: Connection}
+        self.active_connections: Dict[WebSocket, Connection] = {}
+        self.groups: Dict[str, Dict[WebSocket, Connection]] = {}
+        # group -> username -> open local sockets (tabs); a user is present while the count is > 0
+        self.presence: Dict[str, Counter] = {}
+        # group -> users this worker's members were last told about; deltas are computed against it
+        self.announced: Dict[str, set] = {}
+        self._dirty = set()
+        self._flush_handle: asyncio.TimerHandle = None
+        self.stats = FanoutStats()
+        self._tasks = set()
+        self.broker = broker or make_broker()
+        self.worker_id = worker_id
+        self._broker_ready = None
+        # Other workers' users: worker -> group -> usernames, and when each was last heard from
+        self.remote_users: Dict[str, Dict[str, set]] = {}
+        self.remote_seen: Dict[str, float] = {}
+
+    def _join(self, conn: Connection, group_id: str) -> bool:
+        """Returns True if this is the user's first socket in the group on this worker."""
+        conn.group = group_id
+        self.groups.setdefault(group_id, {})[conn.ws] = conn
+        counts = self.presence.setdefault(group_id, Counter())
+        counts[conn.username] += 1
+        return counts[conn.username] == 1
+
+    def _leave(self, conn: Connection) -> bool:
+        """Returns True if that was the user's last socket in the group on this worker."""
+        members = self.groups.get(conn.group)
+        if members is None or members.pop(conn.ws, None) is None: return False
+        if not members: del self.groups[conn.group]
+        counts = self.presence[conn.group]
+        counts[conn.username] -= 1
+        if counts[conn.username]: return False
+        del counts[conn.username]
+        if not counts: del self.presence[conn.group]
+        return True
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _publish(self, event: dict) -> bool:
+        """Hand an event to the broker; a failure is counted and logged, never raised into the caller."""
+        if self._broker_ready is None: self._broker_ready = asyncio.ensure_future(self._start_broker())
+        ready = self._broker_ready
+        try:
+            await ready
+            await self.broker.publish(event)
+            return True
+        except Exception:
+            # A failed start is not cached: the next publish tries again (e.g. once Redis is back)
+            if ready.done() and ready.exception() is not None and self._broker_ready is ready: self._broker_ready = None
+            handled_errors.inc("publish"); log.exception("publishing %s event failed", event.get("kind"))
+            return False
+
+    async def _start_broker(self):
+        await self.broker.start(self._on_event)
+        if self.broker.shared: self._spawn(self._presence_heartbeat())
+
+    async def _on_event(self, event: dict):
+        kind, group_id = event["kind"], event.get("group")
+        if kind == "broadcast":
+            if event.get("cache"): history_cache.apply(group_id, event["cache"])
+            self.deliver(as_frame(event["frame"]), group_id)
+        elif kind == "presence":
+            if event["worker"] != self.worker_id:
+                users = self.remote_users.setdefault(event["worker"], {}).setdefault(group_id, set())
+                users.update(event["joined"]); users.difference_update(event["left"])
+                self.remote_seen[event["worker"]] = time.monotonic()
+            self._presence_dirty(group_id)
+        elif kind == "presence_sync" and event["worker"] != self.worker_id:
+            old = self.remote_users.get(event["worker"], {})
+            new = self.remote_users[event["worker"]] = {g: set(u) for g, u in event["groups"].items()}
+            self.remote_seen[event["worker"]] = time.monotonic()
+            for g in set(old) | set(new):
+                if old.get(g) != new.get(g): self._presence_dirty(g)
+
+    async def _presence_heartbeat(self):
+        """Re-announce local presence and forget workers that stopped announcing theirs."""
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT)
+            groups = {g: sorted(self.local_users(g)) for g in self.groups}
+            try: await self.broker.publish({"kind": "presence_sync", "worker": self.worker_id, "groups": groups})
+            except Exception: handled_errors.inc("presence_heartbeat"); log.exception("presence heartbeat failed")
+            now = time.monotonic()
+            for worker, seen in list(self.remote_seen.items()):
+                if now - seen > 3 * PRESENCE_HEARTBEAT:
+                    del self.remote_seen[worker]
+                    for g in self.remote_users.pop(worker, {}): self._presence_dirty(g)
+
+    def local_users(self, group_id: str) -> set:
+        return set(self.presence.get(group_id, ()))
+
+    def users_in(self, group_id: str) -> set:
+        users = self.local_users(group_id)
+        for groups in self.remote_users.values(): users |= groups.get(group_id, set())
+        return users
+
+    def group_of(self, websocket: WebSocket, default: str = "general") -> str:
+        conn = self.active_connections.get(websocket)
+        return conn.group if conn else default
+
+    def _enqueue(self, conn: Connection, frame: Frame, now: float):
+        try: conn.queue.put_nowait((frame, now))
+        except asyncio.QueueFull: self._evict(conn, "overflow"); return
+        self.stats.frames += 1
+
+    async def _writer(self, conn: Connection):
+        ws, queue, stats = conn.ws, conn.queue, self.stats
+        try:
+            while True:
+                frame, queued_at = await queue.get()
+                payload = frame.encode(conn.fmt)
+                async with asyncio.timeout(SEND_TIMEOUT):
+                    if type(payload) is str: await ws.send_text(payload)
+                    else: await ws.send_bytes(payload)
+                stats.sent += 1
+                elapsed = time.perf_counter() - queued_at
+                stats.delivery_times.append(elapsed)
+                delivery_seconds.observe(elapsed)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self._evict(conn, "timeout")
+        except Exception:
+            log.debug("send to %s failed", conn.username, exc_info=True)
+            self._evict(conn, "error")
+
+    def _evict(self, conn: Connection, reason: str):
+        """Drop a slow or dead client without blocking the caller."""
+        if self.active_connections.get(conn.ws) is not conn: return
+        self.stats.dropped[reason] += 1
+        del self.active_connections[conn.ws]
+        gone = self._leave(conn)
+        if conn.writer is not asyncio.current_task(): conn.writer.cancel()
+        self._spawn(self._after_evict(conn, gone))
+
+    async def _after_evict(self, conn: Connection, gone: bool):
+        try: await asyncio.wait_for(conn.ws.close(code=1008), SEND_TIMEOUT)
+        except Exception: handled_errors.inc("close")
+        await self.broadcast_system_msg(f"{conn.username} خارج شد", conn.group)
+        if gone: await self._publish_presence(conn.group, left=[conn.username])
+
+    async def send_personal(self, websocket: WebSocket, frame):
+        conn = self.active_connections.get(websocket)
+        if conn: self._enqueue(conn, as_frame(frame), time.perf_counter())
 
     async def connect(self, websocket: WebSocket, username: str):
-        await websocket.accept()
-        self.active_connections.append({"ws": websocket, "username": username, "group": "general"})
+        offered = websocket.scope.get("subprotocols") or []
+        fmt = next((f for f in WIRE_FORMATS if f in offered), "json")
+        await websocket.accept(subprotocol=fmt if fmt in offered else None)
+        conn = Connection(websocket, username, "general", fmt)
+        conn.writer = self._spawn(self._writer(conn))
+        self.active_connections[websocket] = conn
+        first = self._join(conn, "general")
+        self._send_user_list(conn)
         await self.broadcast_system_msg(f"{username} وارد شد", "general")
-        await self.broadcast_user_list("general")
+        if first: await self._publish_presence("general", joined=[username])
 
     async def disconnect(self, websocket: WebSocket):
-        user = next((u for u in self.active_connections if u['ws'] == websocket), None)
+        user = self.active_connections.pop(websocket, None)
         if user:
-            self.active_connections.remove(user)
-            await self.broadcast_system_msg(f"{user['username']} خارج شد", user['group'])
-            await self.broadcast_user_list(user['group'])
+            gone = self._leave(user)
+            user.writer.cancel()
+            await self.broadcast_system_msg(f"{user.username} خارج شد", user.group)
+            if gone: await self._publish_presence(user.group, left=[user.username])
 
     async def switch_group(self, websocket: WebSocket, new_group: str):
-        user = next((u for u in self.active_connections if u['ws'] == websocket), None)
+        user = self.active_connections.get(websocket)
         if user:
-            old_group = user['group']
-            user['group'] = new_group
-            await self.broadcast_user_list(old_group)
-            await self.broadcast_user_list(new_group)
-
-    async def broadcast_user_list(self, group_id: str):
-        users = list(set([u['username'] for u in self.active_connections if u['group'] == group_id]))
-        msg = json.dumps({"action": "user_list", "users": users, "count": len(users)})
-        await self.broadcast_to_group_raw(msg, group_id)
-
-    async def broadcast_to_group(self, message_data: dict, group_id: str):
-        await self.broadcast_to_group_raw(json.dumps(message_data), group_id)
-
-    async def broadcast_to_group_raw(self, msg_str: str, group_id: str):
-        for u in self.active_connections:
-            if u['group'] == group_id:
-                try: await u['ws'].send_text(msg_str)
-                except: pass
+            old_group = user.group
+            gone = self._leave(user)
+            first = self._join(user, new_group)
+            self._send_user_list(user)
+            if gone: await self._publish_presence(old_group, left=[user.username])
+            if first: await self._publish_presence(new_group, joined=[user.username])
+
+    # --- Presence: full list once on join, then coalesced joined/left deltas ---
+    async def _publish_presence(self, group_id: str, joined=(), left=()):
+        """Announce a user's first/last local socket in a group; other tabs don't change presence."""
+        await self._publish({"kind": "presence", "worker": self.worker_id, "group": group_id, "joined": list(joined), "left": list(left)})
+
+    def _send_user_list(self, conn: Connection):
+        # The snapshot is what the group's other members were last told, so the next delta applies to it too
+        users = self.announced.get(conn.group)
+        if users is None: users = self.announced[conn.group] = self.users_in(conn.group)
+        users = users | {conn.username}
+        self._enqueue(conn, Frame({"action": "user_list", "users": sorted(users), "count": len(users)}), time.perf_counter())
+
+    def _presence_dirty(self, group_id: str):
+        if group_id not in self.groups and group_id not in self.announced: return
+        self._dirty.add(group_id)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(PRESENCE_DEBOUNCE_MS / 1000, self._flush_presence)
+
+    def _flush_presence(self):
+        self._flush_handle = None
+        dirty, self._dirty = self._dirty, set()
+        for g in dirty:
+            if g not in self.groups: self.announced.pop(g, None); continue
+            current, before = self.users_in(g), self.announced.get(g, set())
+            self.announced[g] = current
+            # A leave and rejoin inside one window (a reconnecting tab) cancels out
+            joined, left = current - before, before - current
+            if joined or left:
+                self.deliver(Frame({"action": "presence", "joined": sorted(joined), "left": sorted(left), "count": len(current)}), g)
+
+    async def broadcast_to_group(self, message_data: dict, group_id: str, cache=None):
+        await self.broadcast_frame(Frame(message_data), group_id, cache)
+
+    async def broadcast_to_group_raw(self, msg_str: str, group_id: str, cache=None):
+        await self.broadcast_frame(Frame(json_str=msg_str), group_id, cache)
+
+    async def broadcast_frame(self, frame: Frame, group_id: str, cache=None):
+        """Publish a frame to the group on every worker; `cache` is a HistoryCache op to apply with it."""
+        await self._publish({"kind": "broadcast", "group": group_id, "frame": frame, "cache": cache})
+
+    def deliver(self, frame: Frame, group_id: str):
+        """Fan a frame out to this worker's members of the group."""
+        members = self.groups.get(group_id)
+        if not members: return
+        # Enqueue only, never await a peer. Snapshot: overflow evicts from `members`.
+        now = time.perf_counter()
+        for u in list(members.values()): self._enqueue(u, frame, now)
+        elapsed = time.perf_counter() - now
+        self.stats.broadcasts += 1
+        self.stats.fanout_times.append(elapsed)
+        fanout_seconds.observe(elapsed)
     
     async def broadcast_system_msg(self, text: str, group_id: str):
         await self.broadcast_to_group({"action": "new", "message": {
@@ -85,322 +895,445 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+class MessageBatcher:
+    """Write-behind pipeline for `send`: one transaction per batch, broadcasts only after commit."""
+    def __init__(self, manager: ConnectionManager, window_ms: float = SEND_BATCH_WINDOW_MS, max_size: int = SEND_BATCH_MAX,
+                 max_backlog: int = SEND_BACKLOG_MAX):
+        self.manager = manager
+        self.window = window_ms / 1000
+        self.max_size = max(1, max_size)
+        self.max_backlog = max(self.max_size, max_backlog)
+        self.queue: asyncio.Queue = None
+        self.task: asyncio.Task = None
+
+    async def submit(self, fields: dict) -> asyncio.Future:
+        """Queue a send, waiting while the backlog is full; the future resolves to its row (None if dropped) once broadcast."""
+        if self.task is None or self.task.done():
+            self.queue = self.queue or asyncio.Queue(self.max_backlog)
+            self.task = asyncio.create_task(self._run())
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((fields, done))
+        return done
+
+    async def _run(self):
+        queue = self.queue
+        while True:
+            items = [await queue.get()]
+            # While a batch commits, new sends pile up and form the next batch
+            if self.window and queue.qsize() < self.max_size - 1: await asyncio.sleep(self.window)
+            while len(items) < self.max_size and not queue.empty(): items.append(queue.get_nowait())
+            batch = [fields for fields, _ in items]
+            try:
+                rows = await run_db(db_send_many, batch, write=True)
+            except Exception:
+                # One bad row must not cost everyone else in the window their messages
+                handled_errors.inc("send_batch"); log.exception("batch of %d messages failed, retrying one by one", len(batch))
+                rows = [await self._send_one(fields) for fields in batch]
+            for (fields, done), row in zip(items, rows):
+                if row is not None:
+                    # Serialized once: the same JSON goes to the cache and into the broadcast frame
+                    row_json = json.dumps(row)
+                    frame = Frame({"action": "new", "message": row}, f'{{"action": "new", "message": {row_json}}}')
+                    await self.manager.broadcast_frame(frame, fields["group_id"], ("new", row, row_json))
+                if not done.done(): done.set_result(row)
+
+    async def _send_one(self, fields: dict):
+        try: return (await run_db(db_send_many, [fields], write=True))[0]
+        except Exception:
+            handled_errors.inc("send_row"); log.exception("dropping message from %s", fields.get("sender"))
+            return None
+
+batcher = MessageBatcher(manager)
+
+@app.get("/stats")
+async def stats():
+    return {"worker": manager.worker_id, "connections": len(manager.active_connections), "remote_workers": len(manager.remote_users),
+            "fanout": manager.stats.snapshot(), "history_cache": history_cache.snapshot(), "maintenance": maintenance.snapshot()}
+
+# Gauges and counters that already exist elsewhere are read when /metrics is scraped, not mirrored
+def _group_sizes():
+    largest = sorted(manager.groups.items(), key=lambda kv: len(kv[1]), reverse=True)[:METRICS_MAX_GROUPS]
+    return {(g,): len(members) for g, members in largest}
+
+def _queue_depths():
+    depths = [c.queue.qsize() for c in manager.active_connections.values()]
+    return {("sum",): sum(depths), ("max",): max(depths, default=0)}
+
+registry.collector("ws_connections", "Open websockets on this worker.", lambda: len(manager.active_connections))
+registry.collector("ws_group_connections", "Open websockets per group (largest groups only).", _group_sizes, labelnames=("group",))
+registry.collector("ws_send_queue_frames", "Frames waiting in per-socket send queues.", _queue_depths, labelnames=("agg",))
+registry.collector("broadcasts_total", "Broadcasts fanned out on this worker.", lambda: manager.stats.broadcasts, "counter")
+registry.collector("frames_enqueued_total", "Frames queued to sockets.", lambda: manager.stats.frames, "counter")
+registry.collector("frames_sent_total", "Frames written to sockets.", lambda: manager.stats.sent, "counter")
+registry.collector("ws_evictions_total", "Sockets dropped for being slow or broken, by reason.",
+                   lambda: {(r,): n for r, n in manager.stats.dropped.items()}, "counter", ("reason",))
+registry.collector("history_cache_lookups_total", "History cache lookups, by result.",
+                   lambda: {("hit",): history_cache.hits, ("miss",): history_cache.misses}, "counter", ("result",))
+registry.collector("history_cache_groups", "Groups held in the history cache.", lambda: len(history_cache.groups))
+registry.collector("send_batch_backlog", "Sends waiting for the next commit.", lambda: batcher.queue.qsize() if batcher.queue else 0)
+registry.collector("db_pool_backlog", "DB calls waiting for a thread, by pool.",
+                   lambda: {("write",): db_write_pool._work_queue.qsize(), ("read",): db_read_pool._work_queue.qsize()}, labelnames=("pool",))
+registry.collector("remote_workers", "Other workers heard from over pub/sub.", lambda: len(manager.remote_users))
+registry.collector("messages_archived_total", "Messages moved to the archive by this worker.", lambda: maintenance.archived, "counter")
+
+def _rss_bytes():
+    with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+if os.path.exists("/proc/self/statm"):  # Linux
+    registry.collector("process_resident_memory_bytes", "Resident memory of this worker.", _rss_bytes)
+
+@app.get("/metrics")
+async def metrics():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post("/debug/profiler")
+async def toggle_profiler(on: bool = True, hz: float = 100):
+    """Start or stop sampling the event loop thread; results on GET /debug/profile."""
+    if not PROFILER_ENABLED: raise HTTPException(404)
+    if on: profiler.start(min(max(hz, 1), 1000))
+    else: profiler.stop()
+    return {"running": profiler.running, "samples": profiler.samples}
+
+@app.get("/debug/profile")
+async def profile(reset: bool = False):
+    """Folded stacks (flamegraph.pl / speedscope input) collected so far."""
+    if not PROFILER_ENABLED: raise HTTPException(404)
+    return Response(profiler.folded(reset), media_type="text/plain; charset=utf-8")
+
+# --- آپلود فایل: streamed, hashed on the way in, stored once per content ---
+class UploadSink:
+    """Temp file that hashes everything written to it; blocking methods, call from a thread."""
+    def __init__(self, ext: str):
+        fd, self.path = tempfile.mkstemp(dir=UPLOAD_TMP_DIR)
+        self.f = os.fdopen(fd, "wb")
+        self.sha = hashlib.sha256()
+        self.ext = ext
+
+    def write(self, chunks: List[bytes]):
+        for c in chunks: self.sha.update(c); self.f.write(c)
+
+    def commit(self):
+        """Move into content-addressed storage; returns (name, already_stored)."""
+        self.f.close()
+        name = f"{self.sha.hexdigest()}.{self.ext}"
+        dest = os.path.join("uploads", name)
+        if os.path.exists(dest): os.remove(self.path); return name, True
+        os.replace(self.path, dest)
+        return name, False
+
+    def discard(self):
+        self.f.close()
+        try: os.remove(self.path)
+        except FileNotFoundError: pass
+
+class MultipartFileReader:
+    """Feeds a multipart body to python-multipart and collects the bytes of the first file part named `field`."""
+    def __init__(self, boundary: bytes, field: str = "file"):
+        self.field = field.encode()
+        self.filename = None  # set once the file part's headers are parsed
+        self.chunks = []      # file bytes parsed but not yet written out
+        self.done = False
+        self._headers, self._name, self._value, self._in_file = {}, b"", b"", False
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self._part_begin, "on_header_field": self._header_field,
+            "on_header_value": self._header_value, "on_header_end": self._header_end,
+            "on_headers_finished": self._headers_finished, "on_part_data": self._part_data,
+            "on_part_end": self._part_end,
+        })
+
+    def _part_begin(self): self._headers = {}
+
+    def _header_field(self, data, start, end): self._name += data[start:end]
+
+    def _header_value(self, data, start, end): self._value += data[start:end]
+
+    def _header_end(self):
+        self._headers[self._name.lower()] = self._value
+        self._name, self._value = b"", b""
+
+    def _headers_finished(self):
+        _, opts = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._in_file = self.filename is None and opts.get(b"name") == self.field and b"filename" in opts
+        if self._in_file: self.filename = opts[b"filename"].decode("utf-8", "replace")
+
+    def _part_data(self, data, start, end):
+        if self._in_file: self.chunks.append(bytes(data[start:end]))
+
+    def _part_end(self):
+        if self._in_file: self.done, self._in_file = True, False
+
+def file_ext(filename: str) -> str:
+    ext = re.sub(r"[^A-Za-z0-9]", "", filename.rsplit(".", 1)[-1] if "." in filename else "")[:10]
+    return ext.lower() or "bin"
+
+async def stream_upload(request: Request):
+    """Receive the "file" field chunk by chunk, enforcing UPLOAD_MAX_BYTES; returns (stored name, already_stored)."""
+    ctype, params = parse_options_header(request.headers.get("content-type", ""))
+    if ctype != b"multipart/form-data" or b"boundary" not in params: raise HTTPException(400, "expected multipart/form-data")
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > UPLOAD_MAX_BYTES + 64 * 1024: raise HTTPException(413, "file too large")
+    loop = asyncio.get_running_loop()
+    reader, sink, size = MultipartFileReader(params[b"boundary"]), None, 0
+    try:
+        async for chunk in request.stream():
+            try: reader.parser.write(chunk)
+            except Exception: raise HTTPException(400, "invalid multipart body")
+            if reader.filename is not None and sink is None:
+                sink = await loop.run_in_executor(None, UploadSink, file_ext(reader.filename))
+            if reader.chunks:
+                size += sum(map(len, reader.chunks))
+                if size > UPLOAD_MAX_BYTES: raise HTTPException(413, "file too large")
+                chunks, reader.chunks = reader.chunks, []
+                await loop.run_in_executor(None, sink.write, chunks)
+            if reader.done: break
+        if not reader.done: raise HTTPException(400, "missing file field")
+        return await loop.run_in_executor(None, sink.commit)
+    except BaseException:
+        if sink: sink.discard()
+        raise
+
 @app.post("/upload-file/")
-async def upload_file(file: UploadFile = File(...)):
-    ext = file.filename.split(".")[-1]
-    name = f"{uuid.uuid4()}.{ext}"
-    with open(f"uploads/{name}", "wb") as f: shutil.copyfileobj(file.file, f)
-    return {"url": f"/uploads/{name}"}
+async def upload_file(request: Request):
+    name, existed = await stream_upload(request)
+    # Render the thumbnail now so the first history load doesn't wait for it
+    if not existed and file_ext(name) in IMAGE_EXTS: asyncio.ensure_future(ensure_thumbnail(name))
+    return {"url": f"/uploads/{name}", "dedup": existed}
+
+# --- سرو فایل‌ها: uploads never change (content-addressed or uuid names), so cache them forever ---
+MEDIA_NAME = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9._-]*$")
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# A thumbnail URL answered with the original may get a real thumbnail later (Pillow installed, transient failure)
+THUMB_FALLBACK_CACHE_CONTROL = "no-cache"
+_thumb_pool = None
+_thumb_jobs: Dict[str, asyncio.Future] = {}
+
+def thumb_url(content: str):
+    """/uploads/<name> of an image -> its /uploads/thumbs/<THUMB_SIZE>/<name> URL, else None."""
+    if not content or not content.startswith("/uploads/"): return None
+    name = content[len("/uploads/"):]
+    return f"/uploads/thumbs/{THUMB_SIZE}/{name}" if MEDIA_NAME.match(name) and file_ext(name) in IMAGE_EXTS else None
+
+async def ensure_thumbnail(name: str) -> bool:
+    """Render uploads/thumbs/<THUMB_SIZE>/<name> in the process pool once; concurrent callers share the job."""
+    # The size is part of the path, so changing THUMB_SIZE renders new files instead of reusing old-size ones
+    size = THUMB_SIZE
+    dest = os.path.join(THUMB_DIR, str(size), name)
+    if os.path.exists(dest): return True
+    if os.path.exists(dest + ".fail"): return False
+    job = _thumb_jobs.get(dest)
+    if job is None:
+        global _thumb_pool
+        if _thumb_pool is None:
+            # spawn: forking a process that runs db threads is unsafe
+            _thumb_pool = ProcessPoolExecutor(THUMB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        job = _thumb_jobs[dest] = asyncio.get_running_loop().run_in_executor(
+            _thumb_pool, make_thumbnail, os.path.abspath(os.path.join("uploads", name)), os.path.abspath(dest), size)
+        job.add_done_callback(lambda _: _thumb_jobs.pop(dest, None))
+    try: return await asyncio.shield(job)
+    except Exception:
+        handled_errors.inc("thumbnail"); log.exception("thumbnail failed for %s", name)
+        return False
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    return any(t.strip().removeprefix("W/") in (etag, "*") for t in if_none_match.split(","))
+
+def media_response(request: Request, path: str, etag: str, media_type: str = None,
+                   cache_control: str = MEDIA_CACHE_CONTROL) -> Response:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request, etag): return Response(status_code=304, headers=headers)
+    # FileResponse answers Range/If-Range itself, so audio can seek without downloading the whole note
+    return FileResponse(path, headers=headers, media_type=media_type)
+
+@app.api_route("/uploads/thumbs/{size}/{name}", methods=["GET", "HEAD"])
+async def get_thumbnail(size: int, name: str, request: Request):
+    if not MEDIA_NAME.match(name) or not os.path.isfile(os.path.join("uploads", name)): raise HTTPException(404)
+    # A page loaded before THUMB_SIZE changed: send it to the current size rather than render any size asked for
+    if size != THUMB_SIZE: return RedirectResponse(f"/uploads/thumbs/{THUMB_SIZE}/{name}", 307)
+    stem = name.rsplit(".", 1)[0]
+    if file_ext(name) in IMAGE_EXTS and await ensure_thumbnail(name):
+        return media_response(request, os.path.join(THUMB_DIR, str(size), name), f'"t{size}-{stem}"', "image/webp")
+    # Pillow missing or not a decodable image: the original is the best we have, but only for now;
+    # no-cache makes browsers revalidate, and the thumbnail's own ETag replaces it once it renders
+    return media_response(request, os.path.join("uploads", name), f'"{stem}"', cache_control=THUMB_FALLBACK_CACHE_CONTROL)
+
+@app.api_route("/uploads/{name}", methods=["GET", "HEAD"])
+async def get_upload(name: str, request: Request):
+    path = os.path.join("uploads", name)
+    if not MEDIA_NAME.match(name) or not os.path.isfile(path): raise HTTPException(404)
+    return media_response(request, path, f'"{name.rsplit(".", 1)[0]}"')
 
 # --- 3. فرانت‌اند (HTML/CSS/JS) ---
-html = """
-<!DOCTYPE html>
-<html lang="fa" dir="rtl">
-<head>
-<meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-<title>Telegram Pro</title>
-<style>
-    :root { --bg:#fff; --sidebar:#fdfdfd; --chat:#728c9a; --mine:#effdde; --other:#fff; --text:#000; --border:#ddd; --accent:#0088cc; }
-    [data-theme="dark"] { --bg:#181818; --sidebar:#212121; --chat:#0f0f0f; --mine:#2b5278; --other:#182533; --text:#fff; --border:#333; --accent:#40a7e3; }
-    * { box-sizing: border-box; tap-highlight-color: transparent; }
-    body { font-family: Tahoma, sans-serif; background: var(--bg); margin: 0; height: 100vh; display: flex; justify-content: center; color: var(--text); overflow: hidden; }
-    .app-container { display: none; width: 100%; max-width: 1200px; height: 100%; background: var(--sidebar); box-shadow: 0 0 20px rgba(0,0,0,0.2); }
-    @media(min-width: 800px){ .app-container{ height: 95vh; margin-top: 2.5vh; border-radius: 12px; overflow: hidden; display: flex;} }
-    .sidebar { width: 320px; border-left: 1px solid var(--border); display: flex; flex-direction: column; background: var(--sidebar); z-index: 2; }
-    .sidebar-header { padding: 15px; border-bottom: 1px solid var(--border); display: flex; justify-content: space-between; align-items: center; background: var(--sidebar); }
-    .group-list { flex: 1; overflow-y: auto; }
-    .group-item { padding: 12px 15px; display: flex; align-items: center; cursor: pointer; transition: 0.2s; border-bottom: 1px solid var(--border); }
-    .group-item:hover, .group-item.active { background: rgba(128,128,128,0.1); }
-    .group-icon { width: 45px; height: 45px; border-radius: 50%; background: var(--accent); color: white; display: flex; justify-content: center; align-items: center; font-size: 20px; margin-left: 10px; }
-    .saved-msgs .group-icon { background: #50bfe6; }
-    .chat-area { flex: 1; display: flex; flex-direction: column; position: relative; background: var(--chat); background-image: url('https://web.telegram.org/img/bg_0.png'); background-size: cover; }
-    .chat-header { padding: 10px; background: var(--sidebar); border-bottom: 1px solid var(--border); display: flex; align-items: center; z-index: 5; }
-    .header-info { flex: 1; margin-right: 10px; }
-    .member-count { font-size: 11px; color: #888; }
-    #messages { flex: 1; overflow-y: scroll; padding: 10px; display: flex; flex-direction: column; gap: 5px; scroll-behavior: smooth; }
-    .msg-row { display: flex; max-width: 85%; }
-    .msg-row.mine { align-self: flex-end; flex-direction: row-reverse; }
-    .msg-row.other { align-self: flex-start; }
-    .bubble { background: var(--other); padding: 6px 10px; border-radius: 10px; position: relative; box-shadow: 0 1px 2px rgba(0,0,0,0.15); font-size: 14px; min-width: 120px; display: flex; flex-direction: column;}
-    .mine .bubble { background: var(--mine); border-bottom-right-radius: 0; }
-    .other .bubble { border-bottom-left-radius: 0; }
-    .sender { font-size: 12px; color: var(--accent); font-weight: bold; margin-bottom: 3px; cursor: pointer; }
-    .meta { font-size: 10px; color: #888; display: flex; justify-content: flex-end; align-items: center; margin-top: 3px; }
-    .ticks { font-size: 14px; color: #4db358; margin-right: 3px; }
-    .reply-preview { border-right: 3px solid var(--accent); background: rgba(0,0,0,0.05); padding: 4px; border-radius: 4px; font-size: 11px; margin-bottom: 4px; cursor: pointer;}
-    .forward-tag { font-size: 11px; color: var(--accent); font-style: italic; margin-bottom: 3px; }
-    .system-msg { align-self: center; background: rgba(0,0,0,0.3); color: white; padding: 3px 10px; border-radius: 10px; font-size: 11px; margin: 5px 0; }
-    .chat-img { max-width: 100%; border-radius: 8px; cursor: pointer; }
-    audio { width: 100%; height: 30px; margin-top: 5px; }
-    .pin-bar { background: var(--sidebar); padding: 8px; border-bottom: 1px solid var(--border); display: none; align-items: center; cursor: pointer; font-size: 13px; }
-    .input-wrapper { background: var(--sidebar); padding: 5px; }
-    .input-box { display: flex; background: var(--bg); border: 1px solid var(--border); border-radius: 20px; align-items: center; padding: 2px 10px; }
-    input { flex: 1; border: none; background: transparent; padding: 10px; outline: none; color: var(--text); }
-    .btn-icon { font-size: 22px; color: #888; cursor: pointer; padding: 0 8px; background: none; border: none; }
-    .modal-overlay { display: none; position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.5); z-index: 1000; justify-content: center; align-items: flex-end; }
-    .modal-sheet { background: var(--sidebar); width: 100%; max-width: 500px; border-radius: 15px 15px 0 0; overflow: hidden; animation: slideUp 0.2s; }
-    .modal-item { padding: 15px; border-bottom: 1px solid var(--border); cursor: pointer; display: flex; align-items: center; gap: 10px; font-size: 15px; }
-    @keyframes slideUp { from { transform: translateY(100%); } to { transform: translateY(0); } }
-    .lightbox { display: none; position: fixed; top:0; left:0; width:100%; height:100%; background:rgba(0,0,0,0.9); z-index:2000; justify-content:center; align-items:center; }
-    .lightbox img { max-width:95%; max-height:95%; border-radius:5px; }
-    .login-box { width: 300px; background: var(--sidebar); padding: 30px; border-radius: 15px; box-shadow: 0 5px 15px rgba(0,0,0,0.2); text-align: center; margin: auto; display: flex; flex-direction: column; gap: 10px;}
-    .back-btn { display: none; font-size: 24px; cursor: pointer; margin-left: 10px; }
-    .scroll-btn { position: absolute; bottom: 80px; right: 20px; background: rgba(0,0,0,0.4); color: white; width: 40px; height: 40px; border-radius: 50%; display: none; justify-content: center; align-items: center; cursor: pointer; z-index: 10; }
-    @media(max-width: 800px) {
-        .app-container { display: none; position: fixed; top:0; left:0; }
-        .sidebar, .chat-area { width: 100%; height: 100%; }
-        .show-chat .sidebar { display: none; } .show-chat .chat-area { display: flex; }
-        .back-btn { display: block; }
-    }
-</style>
-</head>
-<body>
-<div class="login-box" id="loginScreen">
-    <h2 style="color:var(--accent)">Telegram Pro</h2>
-    <input type="text" id="username" placeholder="نام کاربری...">
-    <button onclick="login()" style="padding:12px; background:var(--accent); color:white; border:none; border-radius:8px; cursor:pointer;">شروع چت</button>
-</div>
-<div class="app-container" id="app">
-    <div class="sidebar">
-        <div class="sidebar-header">
-            <b>پیام‌رسان</b>
-            <div><button class="btn-icon" onclick="changeWallpaper()">🖼️</button><button class="btn-icon" onclick="toggleTheme()">🌙</button></div>
-        </div>
-        <div class="group-list">
-            <div class="group-item saved-msgs" onclick="joinGroup('saved')" id="grp-saved"><div class="group-icon">🔖</div><div><b>پیام‌های ذخیره شده</b><br><small>شخصی</small></div></div>
-            <div class="group-item active" onclick="joinGroup('general')" id="grp-general"><div class="group-icon">📢</div><div><b>گروه عمومی</b><br><small id="cnt-general">...</small></div></div>
-            <div class="group-item" onclick="joinGroup('tech')" id="grp-tech"><div class="group-icon">💻</div><div><b>تکنولوژی</b><br><small id="cnt-tech">...</small></div></div>
-        </div>
-    </div>
-    <div class="chat-area">
-        <div class="chat-header">
-            <div class="back-btn" onclick="goBack()">➔</div>
-            <div class="header-info"><b id="chatTitle">گروه عمومی</b><br><span class="member-count" id="onlineCount">در حال اتصال...</span></div>
-            <button class="btn-icon" onclick="toggleSearch()">🔍</button>
-        </div>
-        <div class="pin-bar" id="pinBanner" onclick="scrollToPin()">
-            <div style="border-right: 3px solid var(--accent); height: 25px; margin-left: 10px;"></div>
-            <div style="flex:1"><b style="color:var(--accent)">پین شده</b><br><span id="pinText" style="font-size:11px;">...</span></div><span onclick="unpin(event)" style="padding:5px;">✕</span>
-        </div>
-        <div id="searchBar" style="display:none; padding:10px; background:var(--sidebar);"><input type="text" id="searchInp" placeholder="جستجو..." onkeyup="doSearch()" style="width:100%; border:1px solid #ccc;"></div>
-        <div id="messages" onscroll="checkScroll()"></div>
-        <div class="scroll-btn" id="scrollBtn" onclick="scrollToBottom()">⬇</div>
-        <div class="input-wrapper">
-            <div id="actionInfo" style="display:none; background:rgba(0,0,0,0.05); padding:5px; border-radius:5px; margin-bottom:5px; font-size:12px; justify-content:space-between;"><span id="actionText"></span> <span onclick="cancelAction()" style="color:red; cursor:pointer;">✕</span></div>
-            <div class="input-box">
-                <input type="file" id="fileInp" hidden onchange="uploadFile('image')"><input type="file" id="wallInp" hidden onchange="uploadWall()">
-                <button class="btn-icon" onclick="document.getElementById('fileInp').click()">📎</button>
-                <input type="text" id="msgInp" placeholder="پیام..." autocomplete="off">
-                <button class="btn-icon" id="micBtn" onclick="recordVoice()">🎤</button>
-                <button class="btn-icon btn-send" onclick="sendMsg()">➤</button>
-            </div>
-        </div>
-    </div>
-</div>
-<div class="modal-overlay" id="ctxMenu" onclick="closeMenu(event)"><div class="modal-sheet">
-    <div class="modal-item" onclick="actReply()">↩️ پاسخ</div><div class="modal-item" onclick="actForward()">↪️ فوروارد</div><div class="modal-item" onclick="actCopy()">📋 کپی</div>
-    <div class="modal-item" id="optPin" onclick="actPin()">📌 پین</div><div class="modal-item" id="optEdit" onclick="actEdit()">✏️ ویرایش</div><div class="modal-item" id="optDel" onclick="actDel()" style="color:red">🗑 حذف</div>
-</div></div>
-<div class="modal-overlay" id="fwdMenu" onclick="closeFwd(event)"><div class="modal-sheet">
-    <div style="padding:15px; text-align:center; color:#888;">ارسال به...</div>
-    <div class="modal-item" onclick="doForward('saved')">🔖 پیام‌های ذخیره شده</div><div class="modal-item" onclick="doForward('general')">📢 عمومی</div><div class="modal-item" onclick="doForward('tech')">💻 تکنولوژی</div>
-</div></div>
-<div class="lightbox" id="lightbox" onclick="this.style.display='none'"><img id="lbImg" src=""></div>
-<script>
-    var ws, user, curGroup="general", selMsg, actionData=null, editId=null;
-    if(localStorage.getItem("user")) document.getElementById("username").value = localStorage.getItem("user");
-    if(localStorage.getItem("theme")==="dark") document.body.setAttribute("data-theme", "dark");
-    if(localStorage.getItem("wall")) document.querySelector('.chat-area').style.backgroundImage = `url(${localStorage.getItem("wall")})`;
-    function login(){
-        user = document.getElementById("username").value.trim();
-        if(!user) return;
-        localStorage.setItem("user", user);
-        document.getElementById("loginScreen").style.display="none";
-        document.getElementById("app").style.display= window.innerWidth<800 ? "block" : "flex";
-        connect();
-    }
-    function connect(){
-        // Dynamic IP detection
-        var protocol = window.location.protocol==="https:"?"wss":"ws";
-        ws = new WebSocket(`${protocol}://${window.location.host}/ws/${user}`);
-        ws.onmessage = (e) => processData(JSON.parse(e.data));
-        ws.onclose = () => setTimeout(connect, 3000);
-    }
-    function processData(d){
-        if(d.action === "history") {
-            document.getElementById("messages").innerHTML = "";
-            document.getElementById("pinBanner").style.display="none";
-            d.messages.forEach(m => addMsg(m));
-        }
-        else if(d.action === "new") addMsg(d.message);
-        else if(d.action === "user_list") document.getElementById("onlineCount").innerText = d.count + " نفر آنلاین";
-        else if(d.action === "delete") { var el=document.getElementById("row-"+d.id); if(el) el.remove(); }
-        else if(d.action === "edit") { 
-            var el=document.getElementById("txt-"+d.id); if(el) el.innerHTML=linkify(d.content); 
-            document.getElementById("meta-"+d.id).innerHTML += " (Edited)";
-        }
-        else if(d.action === "pin") showPin(d.content, d.id);
-        else if(d.action === "unpin") document.getElementById("pinBanner").style.display="none";
-    }
-    function addMsg(m){
-        var box = document.getElementById("messages");
-        if(m.msg_type === "system") { box.innerHTML += `<div class="system-msg">${m.content}</div>`; return; }
-        if(m.is_pinned) showPin(m.content, m.id);
-        var isMine = m.sender === user;
-        var row = document.createElement("div"); row.className = `msg-row ${isMine?'mine':'other'}`; row.id = `row-${m.id}`;
-        var content = "";
-        if(m.msg_type==="image") content = `<img src="${m.content}" class="chat-img" onclick="viewImg('${m.content}')">`;
-        else if(m.msg_type==="audio") content = `<audio controls src="${m.content}"></audio>`;
-        else content = `<span id="txt-${m.id}">${linkify(m.content)}</span>`;
-        var replyHtml = "";
-        if(m.reply_to_sender) replyHtml = `<div class="reply-preview"><b>${m.reply_to_sender}</b><br>${short(m.reply_to_content)}</div>`;
-        if(m.forward_from) replyHtml = `<div class="forward-tag">فوروارد از ${m.forward_from}</div>` + replyHtml;
-        row.innerHTML = `<div class="bubble" onclick="openCtx(this, ${m.id}, '${m.sender}', '${m.msg_type}')" data-content="${m.content}">
-            ${!isMine ? `<div class="sender">${m.sender}</div>` : ''} ${replyHtml} ${content}
-            <div class="meta" id="meta-${m.id}">${isMine ? '<span class="ticks">✓✓</span>' : ''} ${m.time} ${m.is_edited ? '(Edited)' : ''}</div></div>`;
-        box.appendChild(row); scrollToBottom();
-    }
-    function joinGroup(gid){
-        curGroup = gid;
-        document.querySelectorAll(".group-item").forEach(e=>e.classList.remove("active"));
-        document.getElementById("grp-"+gid).classList.add("active");
-        var titles = {'saved':'پیام‌های ذخیره شده', 'general':'گروه عمومی', 'tech':'تکنولوژی'};
-        document.getElementById("chatTitle").innerText = titles[gid];
-        ws.send(JSON.stringify({action:"join_group", group:gid}));
-        if(window.innerWidth<800) document.getElementById("app").classList.add("show-chat");
-    }
-    function sendMsg(){
-        var txt = document.getElementById("msgInp").value.trim();
-        if(!txt) return;
-        if(editId) { ws.send(JSON.stringify({action:"edit", id:editId, content:txt})); } 
-        else {
-            var pl = {action:"send", content:txt, msg_type:"text"};
-            if(actionData && actionData.type==="reply") { pl.reply_to_sender = actionData.sender; pl.reply_to_content = actionData.content; }
-            if(actionData && actionData.type==="forward") { pl.forward_from = actionData.from; pl.content = actionData.content; pl.msg_type = actionData.msg_type; }
-            ws.send(JSON.stringify(pl));
-        }
-        resetInput();
-    }
-    async function uploadFile(type){
-        var f = document.getElementById("fileInp").files[0]; if(!f) return;
-        var fd = new FormData(); fd.append("file", f);
-        var res = await fetch("/upload-file/", {method:"POST", body:fd});
-        var j = await res.json();
-        ws.send(JSON.stringify({action:"send", content:j.url, msg_type:type}));
-    }
-    function linkify(txt){ return txt.replace(/(https?:\/\/[^\s]+)/g, '<a href="$1" target="_blank" style="color:var(--accent)">$1</a>'); }
-    function short(t){ return t.length>30 ? t.substring(0,30)+"..." : t; }
-    function scrollToBottom(){ var b=document.getElementById("messages"); b.scrollTop=b.scrollHeight; }
-    function checkScroll(){ var b=document.getElementById("messages"); document.getElementById("scrollBtn").style.display = (b.scrollHeight - b.scrollTop > 500) ? "flex" : "none"; }
-    function openCtx(el, id, sender, type){
-        selMsg = {id:id, sender:sender, type:type, content:el.getAttribute("data-content")};
-        var isMine = sender===user;
-        document.getElementById("optDel").style.display = isMine ? "flex" : "none";
-        document.getElementById("optEdit").style.display = (isMine && type==="text") ? "flex" : "none";
-        document.getElementById("ctxMenu").style.display = "flex";
-    }
-    function closeMenu(e){ if(e.target.id==="ctxMenu") document.getElementById("ctxMenu").style.display="none"; }
-    function actReply(){ setAction("پاسخ به: "+selMsg.sender, "reply"); document.getElementById("ctxMenu").style.display="none"; document.getElementById("msgInp").focus(); }
-    function actCopy(){ navigator.clipboard.writeText(selMsg.content); document.getElementById("ctxMenu").style.display="none"; }
-    function actDel(){ if(confirm("حذف؟")) ws.send(JSON.stringify({action:"delete", id:selMsg.id})); document.getElementById("ctxMenu").style.display="none"; }
-    function actEdit(){ editId = selMsg.id; document.getElementById("msgInp").value = selMsg.content; setAction("ویرایش...", "edit"); document.getElementById("ctxMenu").style.display="none"; }
-    function actPin(){ ws.send(JSON.stringify({action:"pin", id:selMsg.id, content:selMsg.content})); document.getElementById("ctxMenu").style.display="none"; }
-    function unpin(e){ e.stopPropagation(); ws.send(JSON.stringify({action:"unpin"})); }
-    function showPin(txt, id){ document.getElementById("pinBanner").style.display="flex"; document.getElementById("pinText").innerText = short(txt.startsWith("/uploads")?"[فایل]":txt); document.getElementById("pinBanner").onclick = () => document.getElementById("row-"+id).scrollIntoView({behavior:"smooth", block:"center"}); }
-    function actForward(){ document.getElementById("ctxMenu").style.display="none"; document.getElementById("fwdMenu").style.display="flex"; }
-    function closeFwd(e){ if(e.target.id==="fwdMenu") document.getElementById("fwdMenu").style.display="none"; }
-    function doForward(grp){ joinGroup(grp); actionData = {type:"forward", from:selMsg.sender, content:selMsg.content, msg_type:selMsg.type}; sendMsg(); document.getElementById("fwdMenu").style.display="none"; }
-    function setAction(txt, type){ document.getElementById("actionInfo").style.display="flex"; document.getElementById("actionText").innerText = txt; actionData = selMsg; actionData.type = type; }
-    function resetInput() { actionData=null; editId=null; document.getElementById("actionInfo").style.display="none"; document.getElementById("msgInp").value=""; }
-    function cancelAction(){ resetInput(); }
-    function toggleTheme(){ var b=document.body; b.setAttribute("data-theme", b.getAttribute("data-theme")==="dark"?"light":"dark"); localStorage.setItem("theme", b.getAttribute("data-theme")); }
-    function changeWallpaper(){ document.getElementById("wallInp").click(); }
-    function uploadWall(){ var f = document.getElementById("wallInp").files[0]; var r = new FileReader(); r.onload=function(e){ document.querySelector('.chat-area').style.backgroundImage=`url(${e.target.result})`; localStorage.setItem("wall", e.target.result); }; r.readAsDataURL(f); }
-    function toggleSearch(){ var b=document.getElementById("searchBar"); b.style.display = b.style.display==="none"?"block":"none"; if(b.style.display==="block") document.getElementById("searchInp").focus(); }
-    function doSearch(){ var v = document.getElementById("searchInp").value.toLowerCase(); document.querySelectorAll(".bubble").forEach(e=>{ e.parentElement.style.display = e.innerText.toLowerCase().includes(v) ? "flex" : "none"; }); }
-    function viewImg(src){ document.getElementById("lightbox").style.display="flex"; document.getElementById("lbImg").src = src; }
-    function goBack(){ document.getElementById("app").classList.remove("show-chat"); }
-    var mediaRec;
-    async function recordVoice(){ var btn = document.getElementById("micBtn"); if(btn.style.color === "red") { mediaRec.stop(); btn.style.color = "#888"; } else { try { var s = await navigator.mediaDevices.getUserMedia({audio:true}); mediaRec = new MediaRecorder(s); var ch=[]; mediaRec.ondataavailable=e=>ch.push(e.data); mediaRec.onstop=async()=>{ var b=new Blob(ch,{type:'audio/webm'}); var fd=new FormData(); fd.append("file",b,"v.webm"); var r=await fetch("/upload-file/",{method:"POST",body:fd}); var j=await r.json(); ws.send(JSON.stringify({action:"send",content:j.url,msg_type:"audio"})); }; mediaRec.start(); btn.style.color="red"; } catch(e){ alert("نیاز به HTTPS دارد"); } } }
-    document.getElementById("msgInp").onkeyup = (e) => { if(e.key==="Enter") sendMsg(); }
-</script>
-</body>
-</html>
-"""
-
-@app.get("/")
-async def get(): return HTMLResponse(html)
+# Files in STATIC_DIR refer to each other as {{name}}; at startup each reference becomes the
+# /static/<stem>.<hash><ext> URL of the referenced file, so any change to a file changes its URL
+# (and the URL of everything that refers to it) and those URLs can be cached forever
+ASSET_REF = re.compile(r"\{\{([\w.-]+)\}\}")
+ASSET_TYPES = {".html": "text/html; charset=utf-8", ".css": "text/css; charset=utf-8",
+               ".js": "text/javascript; charset=utf-8", ".svg": "image/svg+xml"}
+
+class Asset:
+    __slots__ = ("name", "url", "media_type", "digest", "bodies")
+    def __init__(self, name: str, data: bytes, media_type: str, compress: bool):
+        self.name, self.media_type = name, media_type
+        self.digest = hashlib.sha256(data).hexdigest()[:16]
+        stem, ext = os.path.splitext(name)
+        self.url = f"/static/{stem}.{self.digest}{ext}"
+        self.bodies = {"identity": data}  # Content-Encoding -> body
+        if compress:
+            candidates = {"gzip": gzip.compress(data, 9, mtime=0)}
+            if brotli is not None: candidates["br"] = brotli.compress(data, quality=11)
+            self.bodies.update((enc, body) for enc, body in candidates.items() if len(body) < len(data))
+
+    def etag(self, encoding: str) -> str:
+        # Strong and distinct per encoding: the bytes differ, so a cache must not mix them up
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+class StaticAssets:
+    def __init__(self, root: str):
+        self.root = root
+        self.by_name: Dict[str, Asset] = {}
+        self.by_url: Dict[str, Asset] = {}   # versioned file name -> asset
+        for name in sorted(os.listdir(root)):
+            if os.path.isfile(os.path.join(root, name)): self._build(name, ())
+
+    def _build(self, name: str, referrers: tuple) -> Asset:
+        if name in self.by_name: return self.by_name[name]
+        if name in referrers: raise ValueError(f"static: reference cycle {' -> '.join(referrers + (name,))}")
+        path = os.path.join(self.root, name)
+        if not os.path.isfile(path): raise ValueError(f"static: {referrers[-1]} refers to missing {name}")
+        with open(path, "rb") as f: data = f.read()
+        ext = os.path.splitext(name)[1].lower()
+        if ext in ASSET_TYPES:
+            # Referenced files are built first, so this file's hash covers their versions too
+            data = ASSET_REF.sub(lambda m: self._build(m[1], referrers + (name,)).url, data.decode("utf-8")).encode("utf-8")
+        media_type = ASSET_TYPES.get(ext) or mimetypes.guess_type(name)[0] or "application/octet-stream"
+        asset = Asset(name, data, media_type, compress=ext in ASSET_TYPES)
+        self.by_name[name] = self.by_url[asset.url.rsplit("/", 1)[1]] = asset
+        return asset
+
+def accepted_encoding(accept_encoding: str, offered) -> str:
+    """br, else gzip, if offered and not refused (q=0) by the Accept-Encoding header; identity otherwise."""
+    q = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, param = part.partition(";")
+        param = param.strip()
+        try: q[coding.strip()] = float(param[2:]) if param.startswith("q=") else 1.0
+        except ValueError: continue
+    for coding in ("br", "gzip"):
+        if coding in offered and q.get(coding, q.get("*", 0)) > 0: return coding
+    return "identity"
+
+def asset_response(request: Request, asset: Asset, cache_control: str) -> Response:
+    encoding = accepted_encoding(request.headers.get("accept-encoding", ""), asset.bodies)
+    etag = asset.etag(encoding)
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if etag_matches(request, etag): return Response(status_code=304, headers=headers)
+    if encoding != "identity": headers["Content-Encoding"] = encoding
+    return Response(asset.bodies[encoding], media_type=asset.media_type, headers=headers)
+
+assets = StaticAssets(STATIC_DIR)
+
+@app.api_route("/static/{name}", methods=["GET", "HEAD"])
+async def get_static(name: str, request: Request):
+    asset = assets.by_url.get(name)
+    if asset is None: raise HTTPException(404)
+    return asset_response(request, asset, MEDIA_CACHE_CONTROL)
+
+@app.api_route("/", methods=["GET", "HEAD"])
+async def get(request: Request):
+    # The page itself keeps one URL, so browsers revalidate it every visit; unchanged, that is a bodiless 304
+    return asset_response(request, assets.by_name["index.html"], "no-cache")
 
 @app.websocket("/ws/{username}")
 async def websocket_endpoint(websocket: WebSocket, username: str):
-    await manager.connect(websocket, username)
-    
-    # Load history of general group
-    db = SessionLocal()
-    msgs = db.query(MessageModel).filter(MessageModel.group_id == "general").all()
-    hist = []
-    for m in msgs: hist.append(row_to_dict(m))
-    await websocket.send_text(json.dumps({"action": "history", "messages": hist}))
-    db.close()
-    
     try:
+        await manager.connect(websocket, username)
+
+        # Load latest history page of general group
+        await manager.send_personal(websocket, await history_frame("general"))
+
         while True:
-            data = json.loads(await websocket.receive_text())
-            current_group = next((u['group'] for u in manager.active_connections if u['ws'] == websocket), "general")
+            message = await websocket.receive()
+            started = time.perf_counter()
+            data = decode_incoming(message)
+            if websocket not in manager.active_connections: break  # evicted
+            current_group = manager.group_of(websocket)
             
             if data['action'] == 'join_group':
                 await manager.switch_group(websocket, data['group'])
-                db = SessionLocal()
-                msgs = db.query(MessageModel).filter(MessageModel.group_id == data['group']).all()
-                hist = [row_to_dict(m) for m in msgs]
-                db.close()
-                await websocket.send_text(json.dumps({"action": "history", "messages": hist}))
+                await manager.send_personal(websocket, await history_frame(data['group']))
+
+            elif data['action'] == 'load_older':
+                await manager.send_personal(websocket, await history_frame(current_group, int(data['before']), "older"))
+
+            elif data['action'] == 'search':
+                frame = await run_db(build_search_frame, current_group, str(data['query']), max(0, int(data.get('offset', 0))))
+                await manager.send_personal(websocket, frame)
 
             elif data['action'] == 'send':
-                curr_time = datetime.now().strftime("%H:%M")
-                db = SessionLocal()
-                new_msg = MessageModel(
-                    sender=username, content=data['content'], msg_type=data['msg_type'], time=curr_time,
-                    group_id=current_group, reply_to_sender=data.get('reply_to_sender'), 
-                    reply_to_content=data.get('reply_to_content'), forward_from=data.get('forward_from')
-                )
-                db.add(new_msg); db.commit(); db.refresh(new_msg)
-                db.close()
-                await manager.broadcast_to_group({"action": "new", "message": row_to_dict(new_msg)}, current_group)
+                # Coerced here: a non-string field would only fail later, inside a shared batch
+                if data.get('content') is not None:
+                    curr_time = datetime.now().strftime("%H:%M")
+                    fields = dict(
+                        sender=username, content=str(data['content']), msg_type=str(data.get('msg_type') or "text"), time=curr_time,
+                        group_id=current_group, reply_to_sender=optional_str(data.get('reply_to_sender')),
+                        reply_to_content=optional_str(data.get('reply_to_content')), forward_from=optional_str(data.get('forward_from'))
+                    )
+                    # One send in flight per socket: a client sending in a loop waits for its commits
+                    await (await batcher.submit(fields))
             
             elif data['action'] == 'edit':
-                db = SessionLocal()
-                msg = db.query(MessageModel).filter(MessageModel.id == data['id'], MessageModel.sender == username).first()
-                if msg:
-                    msg.content = data['content']; msg.is_edited = True; db.commit()
-                    await manager.broadcast_to_group({"action": "edit", "id": data['id'], "content": data['content']}, current_group)
-                db.close()
+                # The history cache is keyed by int id; SQLite would also match "12", the cache would not
+                msg_id, content = int(data['id']), str(data['content'])
+                group_id = await run_db(db_edit, msg_id, username, content, write=True)
+                if group_id is not None:
+                    await manager.broadcast_to_group({"action": "edit", "id": msg_id, "content": content}, group_id,
+                                                     ("edit", msg_id, content))
 
             elif data['action'] == 'delete':
-                db = SessionLocal()
-                msg = db.query(MessageModel).filter(MessageModel.id == data['id'], MessageModel.sender == username).first()
-                if msg:
-                    db.delete(msg); db.commit()
-                    await manager.broadcast_to_group({"action": "delete", "id": data['id']}, current_group)
-                db.close()
+                msg_id = int(data['id'])
+                group_id = await run_db(db_delete, msg_id, username, write=True)
+                if group_id is not None:
+                    await manager.broadcast_to_group({"action": "delete", "id": msg_id}, group_id, ("delete", msg_id))
 
             elif data['action'] == 'pin':
-                db = SessionLocal()
-                db.query(MessageModel).filter(MessageModel.group_id == current_group).update({MessageModel.is_pinned: False})
-                msg = db.query(MessageModel).filter(MessageModel.id == data['id']).first()
-                if msg: msg.is_pinned = True; db.commit(); await manager.broadcast_to_group({"action": "pin", "id": msg.id, "content": msg.content}, current_group)
-                db.close()
+                pinned = await run_db(db_pin, current_group, data['id'], write=True)
+                if pinned: await manager.broadcast_to_group({"action": "pin", **pinned}, current_group, ("pin", pinned))
 
             elif data['action'] == 'unpin':
-                db = SessionLocal(); db.query(MessageModel).filter(MessageModel.group_id == current_group).update({MessageModel.is_pinned: False}); db.commit(); db.close()
-                await manager.broadcast_to_group({"action": "unpin"}, current_group)
+                await run_db(db_unpin, current_group, write=True)
+                await manager.broadcast_to_group({"action": "unpin"}, current_group, ("pin", None))
+
+            action_seconds.observe(time.perf_counter() - started, data['action'] if data['action'] in WS_ACTIONS else "other")
 
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Whatever ended the loop, the socket must not stay behind in the groups and presence
         await manager.disconnect(websocket)
 
+def decode_incoming(message: dict) -> dict:
+    """Client frames: binary is msgpack, text is JSON, whichever format was negotiated."""
+    if message["type"] == "websocket.disconnect": raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        if msgpack is None: raise WebSocketDisconnect(1003)
+        return msgpack.unpackb(message["bytes"], raw=False)
+    return json.loads(message["text"])
+
+def optional_str(value):
+    return None if value is None else str(value)
+
 def row_to_dict(m):
-    return {
+    d = {
         "id": m.id, "sender": m.sender, "content": m.content, "msg_type": m.msg_type,
         "time": m.time, "reply_to_sender": m.reply_to_sender, "reply_to_content": m.reply_to_content,
         "is_edited": m.is_edited, "is_pinned": m.is_pinned, "forward_from": m.forward_from
     }
+    if m.msg_type == "image": d["thumb"] = thumb_url(m.content)
+    return d
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", "8000")),
+                ws_per_message_deflate=WS_DEFLATE)
@@ -0,0 +1,146 @@
+"""Counters, gauges and histograms in the Prometheus text format, plus a
+sampling profiler that can be switched on while the server runs.
+
+Metrics are updated from the event loop thread only, so they take no locks:
+an observation is a bisect and two additions. Values that already live
+somewhere (connection counts, queue depths, cache hits) are not mirrored
+here; a collector callback reads them at scrape time.
+"""
+import bisect
+import sys
+import threading
+from collections import Counter as _Tally
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(v) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} counter\n"
+        for lv, v in self.values.items(): yield f"{self.name}{_labels(self.labelnames, lv)} {_num(v)}\n"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [per-bucket counts (last is +Inf), sum]
+
+    def observe(self, value: float, *labelvalues):
+        s = self.series.get(labelvalues)
+        if s is None: s = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect.bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} histogram\n"
+        for lv, (counts, total) in self.series.items():
+            acc = 0
+            for bound, c in zip(self.buckets + ("+Inf",), counts):
+                acc += c
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, lv, le)} {acc}\n"
+            yield f"{self.name}_sum{_labels(self.labelnames, lv)} {_num(total)}\n"
+            yield f"{self.name}_count{_labels(self.labelnames, lv)} {acc}\n"
+
+
+class Collector:
+    """Gauge or counter whose value is read at scrape time.
+
+    `fn` returns a number, or a dict of label-value tuples to numbers.
+    """
+    def __init__(self, name: str, help: str, fn, kind: str = "gauge", labelnames=()):
+        self.name, self.help, self.fn, self.kind, self.labelnames = name, help, fn, kind, tuple(labelnames)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+        value = self.fn()
+        if not isinstance(value, dict): value = {(): value}
+        for lv, v in value.items(): yield f"{self.name}{_labels(self.labelnames, lv)} {_num(v)}\n"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kw) -> Counter: return self.register(Counter(*args, **kw))
+
+    def histogram(self, *args, **kw) -> Histogram: return self.register(Histogram(*args, **kw))
+
+    def collector(self, *args, **kw) -> Collector: return self.register(Collector(*args, **kw))
+
+    def render(self) -> str:
+        return "".join(line for m in self.metrics for line in m.render())
+
+
+class SamplingProfiler:
+    """Samples one thread's Python stack from a background thread.
+
+    Stacks are tallied in the folded format (`outer;inner;leaf count`) that
+    flamegraph.pl and speedscope read. Costs nothing while stopped.
+    """
+    def __init__(self):
+        self.stacks = _Tally()
+        self.samples = 0
+        self.thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, hz: float = 100, target: int = None):
+        """Sample the `target` thread (default: the caller's) `hz` times a second."""
+        if self.running: return
+        target = target or threading.get_ident()
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run, args=(target, 1 / hz), name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.running: self._stop.set(); self.thread.join()
+
+    def _run(self, target: int, interval: float):
+        while not self._stop.wait(interval):
+            frame = sys._current_frames().get(target)
+            if frame is None: return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]})")
+                frame = frame.f_back
+            with self._lock:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def folded(self, reset: bool = False) -> str:
+        with self._lock:
+            out = "".join(f"{s} {n}\n" for s, n in self.stacks.most_common())
+            if reset: self.stacks.clear(); self.samples = 0
+        return out
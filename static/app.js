@@ -0,0 +1,146 @@
+var ws, user, curGroup="general", selMsg, actionData=null, editId=null, hasMore=false, oldestId=0, loadingOlder=false, online=new Set(), retries=0;
+if(localStorage.getItem("user")) document.getElementById("username").value = localStorage.getItem("user");
+if(localStorage.getItem("theme")==="dark") document.body.setAttribute("data-theme", "dark");
+if(localStorage.getItem("wall")) setWall(localStorage.getItem("wall"));
+function login(){
+    user = document.getElementById("username").value.trim();
+    if(!user) return;
+    localStorage.setItem("user", user);
+    document.getElementById("loginScreen").style.display="none";
+    document.getElementById("app").style.display= window.innerWidth<800 ? "block" : "flex";
+    connect();
+}
+function connect(){
+    // Dynamic IP detection
+    var protocol = window.location.protocol==="https:"?"wss":"ws";
+    ws = new WebSocket(`${protocol}://${window.location.host}/ws/${user}`);
+    ws.onmessage = (e) => processData(JSON.parse(e.data));
+    ws.onopen = () => { retries = 0; };
+    // Jittered exponential backoff, so a server restart isn't met by every client at once
+    ws.onclose = () => setTimeout(connect, Math.min(30000, 1000 * 2 ** retries++) * (0.5 + Math.random()));
+}
+function showOnline(){ document.getElementById("onlineCount").innerText = online.size + " نفر آنلاین"; }
+function processData(d){
+    if(d.action === "history") {
+        document.getElementById("messages").innerHTML = "";
+        document.getElementById("pinBanner").style.display="none";
+        hasMore = d.has_more; oldestId = d.messages.length ? d.messages[0].id : 0; loadingOlder = false;
+        d.messages.forEach(m => addMsg(m));
+        if(d.pinned) showPin(d.pinned.content, d.pinned.id);
+    }
+    else if(d.action === "older") {
+        var b = document.getElementById("messages"), h = b.scrollHeight;
+        hasMore = d.has_more; loadingOlder = false;
+        if(d.messages.length) oldestId = d.messages[0].id;
+        d.messages.slice().reverse().forEach(m => addMsg(m, true));
+        b.style.scrollBehavior = "auto"; b.scrollTop += b.scrollHeight - h; b.style.scrollBehavior = "";
+    }
+    else if(d.action === "new") addMsg(d.message);
+    else if(d.action === "user_list") { online = new Set(d.users); showOnline(); }
+    else if(d.action === "presence") { d.joined.forEach(u => online.add(u)); d.left.forEach(u => online.delete(u)); showOnline(); }
+    else if(d.action === "delete") { var el=document.getElementById("row-"+d.id); if(el) el.remove(); }
+    else if(d.action === "edit") { 
+        var el=document.getElementById("txt-"+d.id); if(el) el.innerHTML=linkify(d.content); 
+        var meta=document.getElementById("meta-"+d.id); if(meta) meta.innerHTML += " (Edited)";
+    }
+    else if(d.action === "pin") showPin(d.content, d.id);
+    else if(d.action === "search_results") showSearch(d);
+    else if(d.action === "unpin") document.getElementById("pinBanner").style.display="none";
+}
+function addMsg(m, prepend){
+    var box = document.getElementById("messages");
+    if(m.msg_type === "system") { box.innerHTML += `<div class="system-msg">${m.content}</div>`; return; }
+    if(m.is_pinned) showPin(m.content, m.id);
+    var isMine = m.sender === user;
+    var row = document.createElement("div"); row.className = `msg-row ${isMine?'mine':'other'}`; row.id = `row-${m.id}`;
+    var content = "";
+    if(m.msg_type==="image") content = `<img src="${m.thumb||m.content}" loading="lazy" class="chat-img" onclick="viewImg('${m.content}')">`;
+    else if(m.msg_type==="audio") content = `<audio controls preload="none" src="${m.content}"></audio>`;
+    else content = `<span id="txt-${m.id}">${linkify(m.content)}</span>`;
+    var replyHtml = "";
+    if(m.reply_to_sender) replyHtml = `<div class="reply-preview"><b>${m.reply_to_sender}</b><br>${short(m.reply_to_content)}</div>`;
+    if(m.forward_from) replyHtml = `<div class="forward-tag">فوروارد از ${m.forward_from}</div>` + replyHtml;
+    row.innerHTML = `<div class="bubble" onclick="openCtx(this, ${m.id}, '${m.sender}', '${m.msg_type}')" data-content="${m.content}">
+        ${!isMine ? `<div class="sender">${m.sender}</div>` : ''} ${replyHtml} ${content}
+        <div class="meta" id="meta-${m.id}">${isMine ? '<span class="ticks">✓✓</span>' : ''} ${m.time} ${m.is_edited ? '(Edited)' : ''}</div></div>`;
+    if(prepend) { box.insertBefore(row, box.firstChild); return; }
+    box.appendChild(row); scrollToBottom();
+}
+function joinGroup(gid){
+    curGroup = gid;
+    document.querySelectorAll(".group-item").forEach(e=>e.classList.remove("active"));
+    document.getElementById("grp-"+gid).classList.add("active");
+    var titles = {'saved':'پیام‌های ذخیره شده', 'general':'گروه عمومی', 'tech':'تکنولوژی'};
+    document.getElementById("chatTitle").innerText = titles[gid];
+    ws.send(JSON.stringify({action:"join_group", group:gid}));
+    if(window.innerWidth<800) document.getElementById("app").classList.add("show-chat");
+}
+function sendMsg(){
+    var txt = document.getElementById("msgInp").value.trim();
+    if(!txt) return;
+    if(editId) { ws.send(JSON.stringify({action:"edit", id:editId, content:txt})); } 
+    else {
+        var pl = {action:"send", content:txt, msg_type:"text"};
+        if(actionData && actionData.type==="reply") { pl.reply_to_sender = actionData.sender; pl.reply_to_content = actionData.content; }
+        if(actionData && actionData.type==="forward") { pl.forward_from = actionData.from; pl.content = actionData.content; pl.msg_type = actionData.msg_type; }
+        ws.send(JSON.stringify(pl));
+    }
+    resetInput();
+}
+async function uploadFile(type){
+    var f = document.getElementById("fileInp").files[0]; if(!f) return;
+    var fd = new FormData(); fd.append("file", f);
+    var res = await fetch("/upload-file/", {method:"POST", body:fd});
+    if(!res.ok) { alert("آپلود ناموفق بود"); return; }
+    var j = await res.json();
+    ws.send(JSON.stringify({action:"send", content:j.url, msg_type:type}));
+}
+function linkify(txt){ return txt.replace(/(https?:\/\/[^\s]+)/g, '<a href="$1" target="_blank" style="color:var(--accent)">$1</a>'); }
+function short(t){ return t.length>30 ? t.substring(0,30)+"..." : t; }
+function scrollToBottom(){ var b=document.getElementById("messages"); b.scrollTop=b.scrollHeight; }
+function checkScroll(){
+    var b=document.getElementById("messages"); document.getElementById("scrollBtn").style.display = (b.scrollHeight - b.scrollTop > 500) ? "flex" : "none";
+    if(b.scrollTop < 50 && hasMore && !loadingOlder && oldestId) { loadingOlder = true; ws.send(JSON.stringify({action:"load_older", before:oldestId})); }
+}
+function openCtx(el, id, sender, type){
+    selMsg = {id:id, sender:sender, type:type, content:el.getAttribute("data-content")};
+    var isMine = sender===user;
+    document.getElementById("optDel").style.display = isMine ? "flex" : "none";
+    document.getElementById("optEdit").style.display = (isMine && type==="text") ? "flex" : "none";
+    document.getElementById("ctxMenu").style.display = "flex";
+}
+function closeMenu(e){ if(e.target.id==="ctxMenu") document.getElementById("ctxMenu").style.display="none"; }
+function actReply(){ setAction("پاسخ به: "+selMsg.sender, "reply"); document.getElementById("ctxMenu").style.display="none"; document.getElementById("msgInp").focus(); }
+function actCopy(){ navigator.clipboard.writeText(selMsg.content); document.getElementById("ctxMenu").style.display="none"; }
+function actDel(){ if(confirm("حذف؟")) ws.send(JSON.stringify({action:"delete", id:selMsg.id})); document.getElementById("ctxMenu").style.display="none"; }
+function actEdit(){ editId = selMsg.id; document.getElementById("msgInp").value = selMsg.content; setAction("ویرایش...", "edit"); document.getElementById("ctxMenu").style.display="none"; }
+function actPin(){ ws.send(JSON.stringify({action:"pin", id:selMsg.id, content:selMsg.content})); document.getElementById("ctxMenu").style.display="none"; }
+function unpin(e){ e.stopPropagation(); ws.send(JSON.stringify({action:"unpin"})); }
+function showPin(txt, id){ document.getElementById("pinBanner").style.display="flex"; document.getElementById("pinText").innerText = short(txt.startsWith("/uploads")?"[فایل]":txt); document.getElementById("pinBanner").onclick = () => { var r=document.getElementById("row-"+id); if(r) r.scrollIntoView({behavior:"smooth", block:"center"}); }; }
+function actForward(){ document.getElementById("ctxMenu").style.display="none"; document.getElementById("fwdMenu").style.display="flex"; }
+function closeFwd(e){ if(e.target.id==="fwdMenu") document.getElementById("fwdMenu").style.display="none"; }
+function doForward(grp){ joinGroup(grp); actionData = {type:"forward", from:selMsg.sender, content:selMsg.content, msg_type:selMsg.type}; sendMsg(); document.getElementById("fwdMenu").style.display="none"; }
+function setAction(txt, type){ document.getElementById("actionInfo").style.display="flex"; document.getElementById("actionText").innerText = txt; actionData = selMsg; actionData.type = type; }
+function resetInput() { actionData=null; editId=null; document.getElementById("actionInfo").style.display="none"; document.getElementById("msgInp").value=""; }
+function cancelAction(){ resetInput(); }
+function toggleTheme(){ var b=document.body; b.setAttribute("data-theme", b.getAttribute("data-theme")==="dark"?"light":"dark"); localStorage.setItem("theme", b.getAttribute("data-theme")); }
+function setWall(url){ var c = document.querySelector('.chat-area'); c.style.backgroundImage = `url(${url})`; c.style.backgroundSize = "cover"; }
+function changeWallpaper(){ document.getElementById("wallInp").click(); }
+function uploadWall(){ var f = document.getElementById("wallInp").files[0]; var r = new FileReader(); r.onload=function(e){ setWall(e.target.result); localStorage.setItem("wall", e.target.result); }; r.readAsDataURL(f); }
+function toggleSearch(){ var b=document.getElementById("searchBar"); b.style.display = b.style.display==="none"?"block":"none"; if(b.style.display==="block") document.getElementById("searchInp").focus(); }
+var searchTimer;
+function doSearch(){ clearTimeout(searchTimer); searchTimer = setTimeout(() => { var v = document.getElementById("searchInp").value.trim(); if(!v) { document.getElementById("searchResults").innerHTML = ""; return; } ws.send(JSON.stringify({action:"search", query:v, offset:0})); }, 300); }
+function showSearch(d){
+    var box = document.getElementById("searchResults");
+    if(d.query !== document.getElementById("searchInp").value.trim()) return;
+    if(d.offset === 0) box.innerHTML = d.messages.length ? "" : `<div class="search-hit">نتیجه‌ای یافت نشد</div>`;
+    var more = document.getElementById("searchMore"); if(more) more.remove();
+    d.messages.forEach(m => { var el = document.createElement("div"); el.className = "search-hit"; el.innerHTML = `<b>${m.sender}</b> ${short(m.content)} <small>${m.time}</small>`; el.onclick = () => { var r=document.getElementById("row-"+m.id); if(r) r.scrollIntoView({behavior:"smooth", block:"center"}); }; box.appendChild(el); });
+    if(d.next_offset !== null) box.insertAdjacentHTML("beforeend", `<div class="search-hit" id="searchMore" onclick="searchMore(${d.next_offset})">بیشتر...</div>`);
+}
+function searchMore(offset){ ws.send(JSON.stringify({action:"search", query:document.getElementById("searchInp").value.trim(), offset:offset})); }
+function viewImg(src){ document.getElementById("lightbox").style.display="flex"; document.getElementById("lbImg").src = src; }
+function goBack(){ document.getElementById("app").classList.remove("show-chat"); }
+var mediaRec;
+async function recordVoice(){ var btn = document.getElementById("micBtn"); if(btn.style.color === "red") { mediaRec.stop(); btn.style.color = "#888"; } else { try { var s = await navigator.mediaDevices.getUserMedia({audio:true}); mediaRec = new MediaRecorder(s); var ch=[]; mediaRec.ondataavailable=e=>ch.push(e.data); mediaRec.onstop=async()=>{ var b=new Blob(ch,{type:'audio/webm'}); var fd=new FormData(); fd.append("file",b,"v.webm"); var r=await fetch("/upload-file/",{method:"POST",body:fd}); if(!r.ok) { alert("آپلود ناموفق بود"); return; } var j=await r.json(); ws.send(JSON.stringify({action:"send",content:j.url,msg_type:"audio"})); }; mediaRec.start(); btn.style.color="red"; } catch(e){ alert("نیاز به HTTPS دارد"); } } }
+document.getElementById("msgInp").onkeyup = (e) => { if(e.key==="Enter") sendMsg(); }
@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp())  # main.py creates its db, uploads/ and archive/ in cwd
+import main  # noqa: E402
+from archive import ArchiveStore  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    """Empty messages table and a fresh archive for each test."""
+    def wipe(s):
+        s.query(main.MessageModel).delete()
+        s.execute(main.text("DELETE FROM messages_fts"))
+        s.commit()
+    main.with_session(wipe)
+    monkeypatch.setattr(main, "archive", ArchiveStore(str(tmp_path / "archive")))
+    return main
+
+
+def send(group, *contents, **fields):
+    """Insert text messages into a group; returns their rows."""
+    batch = [dict(sender="u", content=c, msg_type="text", time="12:00", group_id=group, **fields) for c in contents]
+    return main.with_session(main.db_send_many, batch)
@@ -0,0 +1,138 @@
+from fastapi.testclient import TestClient
+
+from conftest import send
+
+
+def assert_matches_db(main, cache, group):
+    """The cached first page must be exactly what a fresh load would return."""
+    frame = cache.frame(group)
+    assert frame is not None
+    msgs, has_more, pinned = main.with_session(main.load_first_page, group)
+    assert frame.msgs == msgs
+    assert (frame.has_more, frame.pinned) == (has_more, pinned)
+    assert frame.json() == main.HistoryFrame("history", msgs, has_more, pinned).json()
+
+
+def filled(main, group):
+    cache = main.HistoryCache()
+    token = cache.begin_fill(group)
+    cache.fill(group, token, *main.with_session(main.load_first_page, group))
+    return cache
+
+
+def new(main, cache, group, content):
+    row = send(group, content)[0]
+    cache.on_new(group, row, main.json.dumps(row))
+    return row
+
+
+def test_fill_is_discarded_after_an_interleaved_write(db):
+    send("g", *(f"m{i}" for i in range(10)))
+    cache = db.HistoryCache()
+    for write in ("new", "edit", "delete", "pin"):
+        token = cache.begin_fill("g")
+        stale = db.with_session(db.load_first_page, "g")
+        if write == "new": new(db, cache, "g", "written during the load")
+        elif write == "edit": cache.on_edit("g", stale[0][-1]["id"], "edited during the load")
+        elif write == "delete": cache.on_delete("g", stale[0][-1]["id"])
+        else: cache.on_pin("g", None)
+        cache.fill("g", token, *stale)
+        assert cache.frame("g") is None, write
+
+    # A fill that started after the write is kept
+    token = cache.begin_fill("g")
+    cache.fill("g", token, *db.with_session(db.load_first_page, "g"))
+    assert_matches_db(db, cache, "g")
+
+
+def test_newer_fill_wins_over_an_older_one(db):
+    send("g", "a", "b")
+    cache = db.HistoryCache()
+    first = cache.begin_fill("g")
+    second = cache.begin_fill("g")
+    cache.fill("g", first, [], False, None)
+    assert cache.frame("g") is None
+    cache.fill("g", second, *db.with_session(db.load_first_page, "g"))
+    assert_matches_db(db, cache, "g")
+
+
+def test_write_through_tracks_the_db(db):
+    rows = send("g", *(f"m{i}" for i in range(db.HISTORY_PAGE - 2)))
+    cache = filled(db, "g")
+    assert_matches_db(db, cache, "g")
+
+    # The page fills up and then starts sliding: has_more flips to True
+    for i in range(4):
+        rows.append(new(db, cache, "g", f"n{i}"))
+        assert_matches_db(db, cache, "g")
+
+    target = rows[-3]["id"]
+    db.with_session(db.db_edit, target, "u", "changed")
+    cache.on_edit("g", target, "changed")
+    assert_matches_db(db, cache, "g")
+
+    for pin in (rows[-1]["id"], rows[-5]["id"], rows[0]["id"]):  # the last one is off the page
+        pinned = db.with_session(db.db_pin, "g", pin)
+        cache.on_pin("g", pinned)
+        assert_matches_db(db, cache, "g")
+    db.with_session(db.db_unpin, "g")
+    cache.on_pin("g", None)
+    assert_matches_db(db, cache, "g")
+
+    # Editing the pinned message updates the banner even when it is older than the page
+    pinned = db.with_session(db.db_pin, "g", rows[0]["id"])
+    cache.on_pin("g", pinned)
+    db.with_session(db.db_edit, rows[0]["id"], "u", "pinned, edited")
+    cache.on_edit("g", rows[0]["id"], "pinned, edited")
+    assert_matches_db(db, cache, "g")
+
+    # Deleting from a page with older messages behind it leaves a hole only the db can fill
+    db.with_session(db.db_delete, rows[-2]["id"], "u")
+    cache.on_delete("g", rows[-2]["id"])
+    assert cache.frame("g") is None
+
+
+def test_delete_keeps_a_page_that_is_the_whole_group(db):
+    rows = send("g", "a", "b", "c")
+    cache = filled(db, "g")
+    db.with_session(db.db_pin, "g", rows[1]["id"])
+    cache.on_pin("g", {"id": rows[1]["id"], "content": "b"})
+    for row in (rows[1], rows[0]):
+        db.with_session(db.db_delete, row["id"], "u")
+        cache.on_delete("g", row["id"])
+        assert_matches_db(db, cache, "g")
+
+
+def test_writes_to_other_groups_leave_the_page_alone(db):
+    send("g", "a")
+    cache = filled(db, "g")
+    token = cache.begin_fill("h")
+    new(db, cache, "h", "elsewhere")
+    cache.on_pin("h", None)
+    assert_matches_db(db, cache, "g")
+    cache.fill("h", token, [], False, None)
+    assert cache.frame("h") is None
+
+
+def test_string_ids_from_clients_still_update_the_cache(db, monkeypatch):
+    monkeypatch.setattr(db, "history_cache", db.HistoryCache())
+    kept, edited, deleted = send("general", "kept", "to edit", "to delete")
+    client = TestClient(db.app)
+
+    def history():
+        with client.websocket_connect("/ws/viewer") as ws:
+            while True:
+                d = ws.receive_json()
+                if d["action"] == "history": return [m["content"] for m in d["messages"]]
+
+    assert history() == ["kept", "to edit", "to delete"]
+    with client.websocket_connect("/ws/u") as ws:
+        ws.send_json({"action": "edit", "id": str(edited["id"]), "content": "edited"})
+        ws.send_json({"action": "delete", "id": str(deleted["id"])})
+        seen = set()
+        while seen != {"edit", "delete"}:
+            d = ws.receive_json()
+            if d["action"] in ("edit", "delete"): assert d["id"] in (edited["id"], deleted["id"]); seen.add(d["action"])
+    assert db.history_cache.frame("general") is not None
+    assert history() == ["kept", "edited"]
+    assert_matches_db(db, db.history_cache, "general")
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+import main
+
+GROUPS = ("general", "tech", "saved")
+USERS = [f"u{i}" for i in range(12)]
+
+
+class FakeWS:
+    """A browser tab that keeps the online list the way the JS client does."""
+    def __init__(self):
+        self.scope = {}
+        self.view = None
+        self.deltas = []
+
+    async def accept(self, subprotocol=None): pass
+
+    async def close(self, code=1000): pass
+
+    async def send_text(self, data):
+        d = json.loads(data)
+        if d["action"] == "user_list": self.view = set(d["users"])
+        elif d["action"] == "presence":
+            self.deltas.append(d)
+            self.view |= set(d["joined"]); self.view -= set(d["left"])
+            assert d["count"] == len(self.view)
+
+
+@pytest.fixture(autouse=True)
+def fast_debounce(monkeypatch):
+    monkeypatch.setattr(main, "PRESENCE_DEBOUNCE_MS", 10)
+
+
+async def settle():
+    await asyncio.sleep(0.05)
+
+
+def assert_views_match(manager, sockets):
+    for ws in sockets:
+        group = manager.active_connections[ws].group
+        assert ws.view == manager.users_in(group), group
+
+
+async def remote(manager, worker, group, joined=(), left=()):
+    await manager._on_event({"kind": "presence", "worker": worker, "group": group, "joined": list(joined), "left": list(left)})
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_snapshot_plus_deltas_equals_users_in_after_churn(seed):
+    async def run():
+        rng = random.Random(seed)
+        manager = main.ConnectionManager(main.LocalBroker(), "w1")
+        sockets, remote_users = [], {}
+        for step in range(300):
+            r = rng.random()
+            if r < 0.3 or not sockets:
+                ws = FakeWS(); await manager.connect(ws, rng.choice(USERS)); sockets.append(ws)
+            elif r < 0.5:
+                await manager.disconnect(sockets.pop(rng.randrange(len(sockets))))
+            elif r < 0.65:
+                await manager.switch_group(rng.choice(sockets), rng.choice(GROUPS))
+            elif r < 0.8:
+                worker, group, user = rng.choice(("w2", "w3")), rng.choice(GROUPS), rng.choice(USERS)
+                present = remote_users.setdefault((worker, group), set())
+                if user in present: present.discard(user); await remote(manager, worker, group, left=[user])
+                else: present.add(user); await remote(manager, worker, group, joined=[user])
+            else:
+                # A tab reconnecting: leave and rejoin inside one debounce window
+                ws = sockets.pop(rng.randrange(len(sockets)))
+                username, group = manager.active_connections[ws].username, manager.active_connections[ws].group
+                await manager.disconnect(ws)
+                ws = FakeWS(); await manager.connect(ws, username); sockets.append(ws)
+                if group != "general": await manager.switch_group(ws, group)
+            await asyncio.sleep(0)
+            if step % 50 == 49:
+                await settle()
+                assert_views_match(manager, sockets)
+        await settle()
+        assert_views_match(manager, sockets)
+        for task in list(manager._tasks): task.cancel()
+    asyncio.run(run())
+
+
+def test_leave_and_rejoin_inside_one_window_sends_nothing():
+    async def run():
+        manager = main.ConnectionManager(main.LocalBroker(), "w1")
+        a, b = FakeWS(), FakeWS()
+        await manager.connect(a, "ali"); await manager.connect(b, "bob")
+        await remote(manager, "w2", "general", joined=["reza"])
+        await settle()
+        assert a.view == {"ali", "bob", "reza"}
+        seen = len(a.deltas)
+
+        await manager.disconnect(b)
+        b = FakeWS(); await manager.connect(b, "bob")
+        await remote(manager, "w2", "general", left=["reza"])
+        await remote(manager, "w2", "general", joined=["reza"])
+        await settle()
+        assert a.deltas[seen:] == []
+        assert a.view == b.view == manager.users_in("general") == {"ali", "bob", "reza"}
+
+        # A second tab of the same user changes nothing either; closing the last one does
+        c = FakeWS(); await manager.connect(c, "bob")
+        await manager.disconnect(b)
+        await settle()
+        assert a.deltas[seen:] == []
+        await manager.disconnect(c)
+        await settle()
+        assert a.deltas[seen:] == [{"action": "presence", "joined": [], "left": ["bob"], "count": 2}]
+        assert a.view == manager.users_in("general")
+        for task in list(manager._tasks): task.cancel()
+    asyncio.run(run())
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+
+import main
+from benchmarks.resp_broker import RespBroker
+from conftest import send
+
+
+class FakeWS:
+    """Keeps every frame it is sent, decoded."""
+    def __init__(self):
+        self.scope = {}
+        self.frames = []
+
+    async def accept(self, subprotocol=None): pass
+
+    async def close(self, code=1000): pass
+
+    async def send_text(self, data): self.frames.append(json.loads(data))
+
+
+@pytest.fixture(autouse=True)
+def fast_presence(monkeypatch):
+    monkeypatch.setattr(main, "PRESENCE_DEBOUNCE_MS", 10)
+    monkeypatch.setattr(main, "PRESENCE_HEARTBEAT", 0.1)
+
+
+async def until(cond, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def own_cache(worker):
+    """Both workers live in this process; each gets its own history_cache while it handles an event."""
+    on_event, worker.cache = worker._on_event, main.HistoryCache()
+
+    async def handle(event):
+        shared, main.history_cache = main.history_cache, worker.cache
+        try: await on_event(event)
+        finally: main.history_cache = shared
+    worker._on_event = handle
+
+
+@asynccontextmanager
+async def two_workers():
+    server = await asyncio.start_server(RespBroker().handle, "127.0.0.1", 0)
+    url = f"redis://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    workers = [main.ConnectionManager(main.RedisBroker(url, "test"), w) for w in ("w1", "w2")]
+    for w in workers:
+        own_cache(w)
+        # Subscribed up front, so neither misses the other's first events
+        w._broker_ready = asyncio.ensure_future(w._start_broker())
+        await w._broker_ready
+    try:
+        yield workers
+    finally:
+        for w in workers:
+            for task in list(w._tasks) + [w.broker.task]: task.cancel()
+            await w.broker.pubsub.aclose(); await w.broker.redis.aclose()
+        server.close()
+        await server.wait_closed()
+
+
+def test_broadcast_reaches_the_other_workers_sockets():
+    async def run():
+        async with two_workers() as (w1, w2):
+            a, b = FakeWS(), FakeWS()
+            await w1.connect(a, "ali"); await w2.connect(b, "bob")
+            await w1.broadcast_to_group({"action": "new", "message": {"id": 1, "content": "hello"}}, "general")
+            received = lambda ws: [f["message"]["content"] for f in ws.frames if f["action"] == "new"]
+            await until(lambda: "hello" in received(b))
+            await until(lambda: "hello" in received(a))
+    asyncio.run(run())
+
+
+def test_edit_and_delete_update_the_other_workers_cache(db):
+    rows = send("general", "a", "b", "c")
+
+    async def run():
+        async with two_workers() as (w1, w2):
+            for w in (w1, w2):
+                token = w.cache.begin_fill("general")
+                w.cache.fill("general", token, *db.with_session(db.load_first_page, "general"))
+            # What the edit and delete handlers do on w1
+            db.with_session(db.db_edit, rows[1]["id"], "u", "edited")
+            await w1.broadcast_to_group({"action": "edit", "id": rows[1]["id"], "content": "edited"}, "general",
+                                        ("edit", rows[1]["id"], "edited"))
+            db.with_session(db.db_delete, rows[2]["id"], "u")
+            await w1.broadcast_to_group({"action": "delete", "id": rows[2]["id"]}, "general", ("delete", rows[2]["id"]))
+            contents = lambda: [m["content"] for m in w2.cache.frame("general").msgs]
+            await until(lambda: contents() == ["a", "edited"])
+            assert w2.cache.frame("general").msgs == db.with_session(db.load_first_page, "general")[0]
+    asyncio.run(run())
+
+
+def test_users_in_is_the_union_of_both_workers():
+    async def run():
+        async with two_workers() as (w1, w2):
+            await w1.connect(FakeWS(), "ali")
+            await w2.connect(FakeWS(), "bob"); await w2.connect(FakeWS(), "reza")
+            await until(lambda: w1.users_in("general") == w2.users_in("general") == {"ali", "bob", "reza"})
+    asyncio.run(run())
+
+
+def test_a_silent_worker_is_dropped_after_three_heartbeats():
+    async def run():
+        async with two_workers() as (w1, w2):
+            await w2.connect(FakeWS(), "bob")
+            await until(lambda: "bob" in w1.users_in("general"))
+            # Heartbeats keep a live worker around well past 3 x PRESENCE_HEARTBEAT
+            await asyncio.sleep(6 * main.PRESENCE_HEARTBEAT)
+            assert "bob" in w1.users_in("general")
+
+            for task in list(w2._tasks): task.cancel()  # w2 stops heartbeating, as if it had died
+            silent = time.monotonic()
+            await until(lambda: "w2" not in w1.remote_seen)
+            assert time.monotonic() - silent > 2 * main.PRESENCE_HEARTBEAT
+            assert w1.users_in("general") == set()
+    asyncio.run(run())
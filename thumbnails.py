@@ -0,0 +1,30 @@
+"""Thumbnail rendering for uploaded images.
+
+Kept apart from main.py so the process-pool workers that run it import only
+this module and Pillow, not the whole app.
+"""
+import os
+
+try: from PIL import Image, ImageOps
+except ImportError: Image = None
+
+
+def make_thumbnail(src: str, dest: str, size: int) -> bool:
+    """Write a WebP of `src` that fits in size x size to `dest`; False if it can't be rendered.
+
+    A file that isn't a decodable image leaves `dest`.fail behind so it isn't retried.
+    """
+    if Image is None: return False
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    try:
+        with Image.open(src) as im:
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((size, size))
+            if im.mode not in ("RGB", "RGBA"): im = im.convert("RGBA" if im.mode in ("P", "LA", "PA") else "RGB")
+            im.save(tmp, "WEBP", quality=80)
+        os.replace(tmp, dest)
+        return True
+    except Exception:  # not an image, truncated, decompression bomb, ...
+        if os.path.exists(tmp): os.remove(tmp)
+        open(dest + ".fail", "wb").close()
+        return False